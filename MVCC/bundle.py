@@ -0,0 +1,216 @@
+"""
+    versioned model bundle: a directory with
+        manifest.json: format version, model hyper-parameters, scaler, label encoder classes,
+                       name / shape / dtype of every tensor
+        tensors.pt: flat dict of the state_dicts (GCN views, CPM decoders and encoder, classifier), the class prototypes
+                    and, unless inference_only, the training state (ref_h, ref_labels)
+    loading builds the modules from the manifest and assigns the tensors, nothing is un-pickled,
+    with mmap the tensors are only read from disk when they are used
+
+    usage:
+        save_bundle(mvccmodel, 'model/bundle', inference_only=True)
+        mvccmodel = load_bundle('model/bundle')
+"""
+import os
+import json
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler, LabelEncoder
+from MVCC.model import MVCCModel, CPMNets, scGNN, ClassPrototypes, device
+from MVCC.classifiers import GCNClassifier, CNNClassifier, FCClassifier, FCClassifier2
+
+BUNDLE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+TENSOR_FILE = 'tensors.pt'
+
+
+def _classifier_config(cpm_model):
+    '''
+    :return: classifier_name, classifier_hidden_units of cpm_model (also for models saved before they were stored)
+    '''
+    classifier = cpm_model.classifier
+    if hasattr(cpm_model, 'classifier_name'):
+        return cpm_model.classifier_name, cpm_model.classifier_hidden_units
+    if isinstance(classifier, FCClassifier):
+        return 'FC', classifier.fcn[0].out_features
+    if isinstance(classifier, FCClassifier2):
+        return 'FC2', 64
+    if isinstance(classifier, CNNClassifier):
+        return 'CNN', 64
+    if isinstance(classifier, GCNClassifier):
+        return 'GCN', 64
+    raise ValueError("unknown classifier {:}".format(type(classifier).__name__))
+
+
+def save_bundle(model, path, inference_only=False):
+    '''
+    :param model: trained MVCCModel
+    :param path: bundle directory
+    :param inference_only: leave out the training state (ref_h, ref_labels)
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    cpm_model = model.cpm_model
+    classifier_name, classifier_hidden_units = _classifier_config(cpm_model)
+
+    tensors = {}
+    for i, gcn_model in enumerate(model.gcn_models):
+        for name, value in gcn_model.state_dict().items():
+            tensors['gcn.{:}.{:}'.format(i, name)] = value
+    for name, value in cpm_model.net.state_dict().items():
+        tensors['cpm.net.' + name] = value
+    if cpm_model.encoder is not None:
+        for name, value in cpm_model.encoder.state_dict().items():
+            tensors['cpm.encoder.' + name] = value
+    for name, value in cpm_model.classifier.state_dict().items():
+        tensors['cpm.classifier.' + name] = value
+    prototypes = getattr(model, 'prototypes', None)
+    if prototypes is not None:
+        tensors['prototypes.classes'] = prototypes.classes
+        tensors['prototypes.prototypes'] = prototypes.prototypes
+    if not inference_only:
+        if model.ref_h is not None:
+            tensors['ref_h'] = model.ref_h
+        if model.ref_labels is not None:
+            tensors['ref_labels'] = model.ref_labels
+    tensors = {name: value.detach().cpu().contiguous() for name, value in tensors.items()}
+
+    scaler = cpm_model.scaler
+    label_encoder = model.label_encoder
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'inference_only': inference_only,
+        'lsd': model.lsd,
+        'class_num': model.class_num,
+        'view_num': model.view_num,
+        'gcn_input_dim': model.gcn_models[0].conv1.in_channels,
+        'gcn_middle_out': model.gcn_models[0].conv1.out_channels,
+        'classifier_name': classifier_name,
+        'classifier_hidden_units': classifier_hidden_units,
+        'encoder_hidden_units': None if cpm_model.encoder is None else cpm_model.encoder[0].out_features,
+        'n_prototypes': None if prototypes is None else prototypes.n_prototypes,
+        'scaler': None if scaler is None else {
+            'mean': scaler.mean_.tolist(),
+            'scale': scaler.scale_.tolist(),
+            'var': scaler.var_.tolist(),
+            'n_samples_seen': int(scaler.n_samples_seen_),
+        },
+        'label_encoder': None if label_encoder is None else label_encoder.classes_.tolist(),
+        'tensors': {name: {'shape': list(value.shape), 'dtype': str(value.dtype).replace('torch.', '')}
+                    for name, value in tensors.items()},
+    }
+
+    # write to temporary files and swap them in: a loaded bundle memory-maps tensors.pt, overwriting it in place
+    # (e.g. fit after load_bundle of the same directory) would pull the pages from under the loaded tensors
+    tmp_tensor_file = os.path.join(path, TENSOR_FILE + '.tmp')
+    tmp_manifest_file = os.path.join(path, MANIFEST_FILE + '.tmp')
+    torch.save(tensors, tmp_tensor_file)
+    with open(tmp_manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_tensor_file, os.path.join(path, TENSOR_FILE))
+    # the manifest is swapped in last, a bundle without it is incomplete
+    os.replace(tmp_manifest_file, os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest['version'] > BUNDLE_VERSION:
+        raise ValueError("bundle version {:} is newer than this MVCC (version {:})".format(
+            manifest['version'], BUNDLE_VERSION))
+    return manifest
+
+
+def _check_tensors(manifest, tensors):
+    '''
+    the tensors must be exactly the ones listed in the manifest, with the listed shape and dtype
+    '''
+    expected = manifest['tensors']
+    missing = sorted(set(expected) - set(tensors))
+    unexpected = sorted(set(tensors) - set(expected))
+    if missing or unexpected:
+        raise ValueError("{:} does not match the manifest, missing {:}, unexpected {:}".format(
+            TENSOR_FILE, missing, unexpected))
+    for name, spec in expected.items():
+        value = tensors[name]
+        if list(value.shape) != spec['shape'] or str(value.dtype).replace('torch.', '') != spec['dtype']:
+            raise ValueError("tensor {:} is {:} {:}, the manifest says {:} {:}".format(
+                name, list(value.shape), str(value.dtype).replace('torch.', ''), spec['shape'], spec['dtype']))
+
+
+def _load_module(module, tensors, prefix):
+    state = {name[len(prefix):]: value for name, value in tensors.items() if name.startswith(prefix)}
+    # assign keeps the (memory-mapped) loaded tensors instead of copying them into fresh parameters
+    module.load_state_dict(state, assign=True)
+    return module
+
+
+def load_bundle(path, map_location=None, mmap=True, save_path=''):
+    '''
+    :param path: bundle directory
+    :param map_location: device of the model, None is the default device of MVCC
+    :param mmap: memory-map tensors.pt, tensors are read lazily (only on the cpu)
+    :param save_path: save_path of the rebuilt MVCCModel (where further training writes its files)
+    :return: MVCCModel ready for predict
+    '''
+    manifest = read_manifest(path)
+    map_location = device if map_location is None else torch.device(map_location)
+    tensors = torch.load(os.path.join(path, TENSOR_FILE), map_location='cpu', mmap=mmap, weights_only=True)
+    _check_tensors(manifest, tensors)
+
+    label_encoder = None
+    if manifest['label_encoder'] is not None:
+        label_encoder = LabelEncoder()
+        label_encoder.classes_ = np.array(manifest['label_encoder'])
+
+    model = MVCCModel(lsd=manifest['lsd'],
+                      class_num=manifest['class_num'],
+                      view_num=manifest['view_num'],
+                      save_path=save_path,
+                      label_encoder=label_encoder)
+    for i in range(manifest['view_num']):
+        gcn_model = scGNN(manifest['gcn_input_dim'], manifest['gcn_middle_out'])
+        model.gcn_models.append(_load_module(gcn_model, tensors, 'gcn.{:}.'.format(i)).to(map_location).eval())
+
+    cpm_model = CPMNets(manifest['view_num'],
+                        manifest['gcn_middle_out'],
+                        manifest['lsd'],
+                        manifest['class_num'],
+                        model.model_path,
+                        classifier_name=manifest['classifier_name'],
+                        classifier_hidden_units=manifest['classifier_hidden_units'])
+    _load_module(cpm_model.net, tensors, 'cpm.net.')
+    _load_module(cpm_model.classifier, tensors, 'cpm.classifier.')
+    if manifest['encoder_hidden_units'] is not None:
+        cpm_model.encoder = torch.nn.Sequential(
+            torch.nn.Linear(manifest['gcn_middle_out'] * manifest['view_num'], manifest['encoder_hidden_units']),
+            torch.nn.ReLU(),
+            torch.nn.Linear(manifest['encoder_hidden_units'], manifest['lsd']),
+        )
+        _load_module(cpm_model.encoder, tensors, 'cpm.encoder.')
+    model.cpm_model = cpm_model.to(map_location).eval()
+
+    if manifest['scaler'] is not None:
+        scaler = StandardScaler()
+        scaler.mean_ = np.array(manifest['scaler']['mean'])
+        scaler.scale_ = np.array(manifest['scaler']['scale'])
+        scaler.var_ = np.array(manifest['scaler']['var'])
+        scaler.n_samples_seen_ = manifest['scaler']['n_samples_seen']
+        scaler.n_features_in_ = scaler.mean_.shape[0]
+        model.cpm_model.scaler = scaler
+        model.scaler = scaler
+
+    if manifest.get('n_prototypes') is not None:
+        prototypes = ClassPrototypes.__new__(ClassPrototypes)
+        prototypes.n_prototypes = manifest['n_prototypes']
+        prototypes.classes = tensors['prototypes.classes']
+        prototypes.prototypes = tensors['prototypes.prototypes']
+        model.prototypes = prototypes.to(map_location)
+
+    if 'ref_h' in tensors:
+        model.ref_h = tensors['ref_h'].to(map_location)
+        model.cpm_model.ref_h = model.ref_h
+    if 'ref_labels' in tensors:
+        model.ref_labels = tensors['ref_labels'].to(map_location)
+        model.cpm_model.ref_labels = model.ref_labels
+    return model
@@ -2,30 +2,46 @@ import torch.nn as nn
 import torch
 from sklearn.model_selection import train_test_split
 from torch import optim
-from torch.utils.data import TensorDataset, DataLoader
 from torch_geometric.nn import GCNConv
+from torch_geometric.utils import k_hop_subgraph
 import torch.nn.functional as F
-from MVCC.util import construct_graph_with_knn
+from MVCC.util import knn_edge_index
 import numpy as np
 import os
+import copy
+import threading
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
-def evaluate(val_dataloader, model):
+def evaluate(val_x, val_y, model, batch_size=4096):
+    '''
+    :return: accuracy of model on (val_x, val_y), a 0-dim tensor on the device of val_y
+    '''
     model.eval()
     with torch.no_grad():
-        # return acc
-        pred_list = []
-        true_list = []
-        for b_data, b_label in val_dataloader:
-            logits = model(b_data)
-            pred = logits.argmax(dim=1)
-            pred_list.append(pred)
-            true_list.append(b_label)
-        preds = torch.concat(pred_list)
-        trues = torch.concat(true_list)
-
-        acc = (preds == trues).sum().item() / preds.shape[0]
-        return acc
+        correct = torch.zeros((), dtype=torch.long, device=val_y.device)
+        for start in range(0, val_x.shape[0], batch_size):
+            rows = torch.arange(start, min(start + batch_size, val_x.shape[0]), device=val_x.device)
+            pred = model.forward_rows(val_x, rows).argmax(dim=1)
+            correct += (pred == val_y[rows]).sum()
+        return correct.float() / val_y.shape[0]
+
+
+def _save_replace(model, path):
+    # write to a temporary file first, readers never see a partial file
+    tmp_path = path + '.tmp'
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_async(model, path):
+    '''
+    torch.save a copy of model in a background thread
+    :return: the thread, join it to wait for the file
+    '''
+    model = copy.deepcopy(model).cpu()
+    thread = threading.Thread(target=_save_replace, args=(model, path))
+    thread.start()
+    return thread
 
 class FocalLoss(nn.Module):
     def __init__(self, gamma, alpha):
@@ -57,7 +73,18 @@ class Classifier(torch.nn.Module):
     def __init__(self):
         super(Classifier, self).__init__()
 
+    def forward_rows(self, data, rows):
+        '''
+        logits of data[rows], classifiers that look at other cells (GCNClassifier) see all of data
+        '''
+        return self(data[rows])
+
     def train_classifier(self, data, labels, patience, save_path, test_size, batch_size=128, epochs=300, lr=1e-3):
+        '''
+        batches are slices of an on-device permutation, the weights of the best validation accuracy are kept
+        in memory and restored at the end, classifier.pt is then written once in the background
+        :return: the thread writing classifier.pt
+        '''
         print("Train  classifier")
 
         optimizer_for_classifier = optim.Adam(params=self.parameters(), lr=lr)
@@ -77,51 +104,44 @@ class Classifier(torch.nn.Module):
 
         train_x, val_x = torch.from_numpy(train_x).float().to(device), torch.from_numpy(val_x).float().to(device)
         train_y, val_y = torch.from_numpy(train_y).long().to(device), torch.from_numpy(val_y).long().to(device)
-
-        dataset_train = TensorDataset(train_x, train_y)
-        dataloader_train = DataLoader(dataset_train, shuffle=True, batch_size=batch_size)
-        dataset_val = TensorDataset(val_x, val_y)
-        dataloader_val = DataLoader(dataset_val, shuffle=False, batch_size=batch_size)
+        n_train = train_x.shape[0]
 
         # update classifier
         val_max_acc = 0
+        best_state = None
         stop = 0
         for epoch in range(epochs):
             self.train()
-            c_loss_total = 0
-            train_pred_arr = []
-            train_true_label = []
-            for batch in dataloader_train:
-                b_h, b_label = batch
-                b_h = b_h.to(device)
-                b_label = b_label.to(device)
-                logits = self(b_h)
+            c_loss_total = torch.zeros((), device=device)
+            train_correct = torch.zeros((), dtype=torch.long, device=device)
+            perm = torch.randperm(n_train, device=device)
+            for start in range(0, n_train, batch_size):
+                batch = perm[start:start + batch_size]
+                b_label = train_y[batch]
+                logits = self.forward_rows(train_x, batch)
                 c_loss = criterion(logits, b_label)
 
                 optimizer_for_classifier.zero_grad()
                 c_loss.backward()
                 optimizer_for_classifier.step()
 
-                train_pred_arr.append(logits.detach().argmax(dim=1))
-                train_true_label.append(b_label.detach())
-                c_loss_total += c_loss.detach().item()
+                train_correct += (logits.detach().argmax(dim=1) == b_label).sum()
+                c_loss_total += c_loss.detach()
 
-            preds = torch.concat(train_pred_arr)
-            trues = torch.concat(train_true_label)
-            train_acc = (preds == trues).sum() / trues.shape[0]
+            train_acc = train_correct.item() / n_train
             '''
                 early stopping
             '''
-            val_acc = evaluate(dataloader_val, self)
+            val_acc = evaluate(val_x, val_y, self, batch_size).item()
 
             if val_max_acc < val_acc:
                 val_max_acc = val_acc
                 stop = 0
                 print(
-                    'epoch {:}: train classification loss = {:.3f}, train acc is {:.3f}, val max acc is {:.3f}, save the model.'.format(
+                    'epoch {:}: train classification loss = {:.3f}, train acc is {:.3f}, val max acc is {:.3f}, keep the model.'.format(
                         epoch, c_loss, train_acc, val_max_acc))
 
-                torch.save(self, os.path.join(save_path, 'classifier.pt'))
+                best_state = {name: value.detach().clone() for name, value in self.state_dict().items()}
             else:
                 stop += 1
                 if stop > patience:
@@ -129,6 +149,10 @@ class Classifier(torch.nn.Module):
                         epoch, train_acc, val_max_acc))
                     break
 
+        if best_state is not None:
+            self.load_state_dict(best_state)
+        return save_async(self, os.path.join(save_path, 'classifier.pt'))
+
 class CNNClassifier(Classifier):
     def __init__(self, input_dim, class_num):
         super(CNNClassifier, self).__init__()
@@ -193,11 +217,49 @@ class GCNClassifier(Classifier):
         super(GCNClassifier, self).__init__()
         self.conv1 = GCNConv(input_dim, 1024)
         self.conv2 = GCNConv(1024, output_dim)
+        # (input, its _version, edge_index) of the last inputs (e.g. the train and the validation cells),
+        # the inputs are held so their memory can't be reused
+        self._knn_cache = []
 
-    def forward(self, data):
-        g_data = construct_graph_with_knn(data.detach().cpu().numpy())
-        x, edge_index = g_data.x.to(device), g_data.edge_index.to(device)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_knn_cache'] = []
+        return state
+
+    def __setstate__(self, state):
+        if state.get('_knn_cache') is None:
+            state['_knn_cache'] = []
+        super(GCNClassifier, self).__setstate__(state)
+
+    def knn_graph(self, data, max_cached=2):
+        '''
+        kNN graph of data, rebuilt only when data is not one of the last max_cached tensors (or was changed in place)
+        '''
+        for i, (cached, version, edge_index) in enumerate(self._knn_cache):
+            if cached.data_ptr() == data.data_ptr() and cached.shape == data.shape \
+                    and cached.device == data.device and version == data._version:
+                self._knn_cache.append(self._knn_cache.pop(i))
+                return edge_index
+        edge_index = knn_edge_index(data.detach())
+        self._knn_cache = self._knn_cache[-(max_cached - 1):] if max_cached > 1 else []
+        self._knn_cache.append((data.detach(), data._version, edge_index))
+        return edge_index
+
+    def convolve(self, x, edge_index):
         x = F.relu(self.conv1(x, edge_index))
-        x = self.conv2(x, edge_index)
-        return x
+        return self.conv2(x, edge_index)
+
+    def forward(self, data):
+        x = data.to(device)
+        return self.convolve(x, self.knn_graph(x))
 
+    def forward_rows(self, data, rows):
+        '''
+        logits of data[rows] on the kNN graph of all of data (built once per data),
+        two convolutions reach the 2-hop neighborhood of rows, the degrees (GCN normalization) of those cells need
+        one more hop
+        '''
+        x = data.to(device)
+        subset, edge_index, mapping, _ = k_hop_subgraph(rows, 3, self.knn_graph(x), relabel_nodes=True,
+                                                        num_nodes=x.shape[0])
+        return self.convolve(x[subset], edge_index)[mapping]
@@ -0,0 +1,202 @@
+"""
+    cache of the per-view graphs of (similarity matrix, k)
+    key: a fingerprint of the matrix (shape, dtype and a strided sample of rows), a key given by the caller,
+        or the hash of the whole matrix (content_hash=True)
+    memory tier: LRU of the most recent graphs
+    the propagation matrix (and the degrees) of a graph are only computed (and stored) once a caller asks for them
+    disk tier: one .npz per graph, by default next to data.h5
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+import h5py
+from MVCC.util import construct_sparse_adjacent_matrix_with_MNN, gcn_propagation
+
+CACHE_VERSION = 2
+
+
+def hash_similarity_mat(similarity_mat, k):
+    '''
+    :param similarity_mat: ndarray, scipy.sparse matrix or h5py dataset (cells * cells)
+    :param k: number of neighbors
+    :return: hex digest identifying the graph built from (similarity_mat, k)
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    h.update('v{:}_k{:}_{:}_{:}'.format(CACHE_VERSION, k, similarity_mat.shape, similarity_mat.dtype).encode())
+    if sp.issparse(similarity_mat):
+        similarity_mat = similarity_mat.tocsr()
+        for arr in (similarity_mat.indptr, similarity_mat.indices, similarity_mat.data):
+            h.update(np.ascontiguousarray(arr).view(np.uint8))
+    else:
+        if not isinstance(similarity_mat, h5py.Dataset):
+            similarity_mat = np.asarray(similarity_mat)
+        # hash row blocks, avoid copying (or reading) the whole matrix at once
+        step = max(1, (1 << 26) // max(1, similarity_mat.dtype.itemsize * similarity_mat.shape[1]))
+        for start in range(0, similarity_mat.shape[0], step):
+            h.update(np.ascontiguousarray(similarity_mat[start:start + step]).view(np.uint8))
+    return h.hexdigest()
+
+
+def fingerprint_similarity_mat(similarity_mat, k, n_rows=16):
+    '''
+    cheap key of (similarity_mat, k): shape, dtype, number of stored values (sparse) and n_rows rows spread over the
+    matrix, a matrix that only differs outside of these rows gets the same key (use hash_similarity_mat then)
+    :return: hex digest
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    h.update('v{:}_k{:}_{:}_{:}'.format(CACHE_VERSION, k, similarity_mat.shape, similarity_mat.dtype).encode())
+    rows = np.unique(np.linspace(0, similarity_mat.shape[0] - 1, n_rows).astype(np.int64))
+    if sp.issparse(similarity_mat):
+        similarity_mat = similarity_mat.tocsr()
+        h.update('nnz{:}'.format(similarity_mat.nnz).encode())
+        sample = similarity_mat[rows]
+        for arr in (sample.indptr, sample.indices, sample.data):
+            h.update(np.ascontiguousarray(arr).view(np.uint8))
+    else:
+        if not isinstance(similarity_mat, h5py.Dataset):
+            similarity_mat = np.asarray(similarity_mat)
+        h.update(np.ascontiguousarray(similarity_mat[rows]).view(np.uint8))
+    return h.hexdigest()
+
+
+def add_propagation(entry):
+    '''
+    add propagation and the degrees to a graph entry (in place)
+    :return: entry
+    '''
+    if 'propagation' not in entry:
+        adj = entry['adj']
+        entry['deg'] = np.asarray(adj.sum(axis=1)).reshape(-1).astype(np.float32)
+        entry['deg_self_loop'] = entry['deg'] + 1
+        entry['propagation'] = gcn_propagation(adj, entry['deg_self_loop'])
+    return entry
+
+
+def build_graph_entry(similarity_mat, k, propagation=False):
+    '''
+    :param propagation: also compute the propagation matrix and the degrees
+    :return: dict
+        adj: MNN adjacency, csr_matrix (cells * cells)
+        if asked for:
+        deg: degree of adj
+        deg_self_loop: degree of adj + I, the degree GCNConv normalizes with
+        propagation: D^-1/2 (adj + I) D^-1/2, csr_matrix float32
+    '''
+    entry = {'adj': construct_sparse_adjacent_matrix_with_MNN(similarity_mat, k)}
+    if propagation:
+        add_propagation(entry)
+    return entry
+
+
+class GraphCache(object):
+    def __init__(self, cache_dir=None, max_items=16, content_hash=False):
+        '''
+        :param cache_dir: directory of the disk tier, None keeps the cache in memory only
+        :param max_items: number of graphs kept in memory
+        :param content_hash: key the graphs on a hash of the whole similarity matrix instead of its fingerprint
+            (reads the whole matrix on every lookup)
+        '''
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.content_hash = content_hash
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # views may be built from several threads at once
+        self.lock = threading.Lock()
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _load(self, key):
+        with np.load(self._file(key)) as f:
+            n = int(f['n'])
+            entry = {'adj': sp.csr_matrix((np.ones(f['indices'].shape[0], dtype=np.int64), f['indices'], f['indptr']),
+                                          shape=(n, n))}
+            if 'prop_data' in f:
+                entry['propagation'] = sp.csr_matrix((f['prop_data'], f['prop_indices'], f['prop_indptr']),
+                                                     shape=(n, n))
+                entry['deg'] = f['deg']
+                entry['deg_self_loop'] = f['deg'] + 1
+            return entry
+
+    def _save(self, key, entry):
+        arrays = {
+            'n': entry['adj'].shape[0],
+            'indptr': entry['adj'].indptr,
+            'indices': entry['adj'].indices,
+        }
+        if 'propagation' in entry:
+            arrays['prop_indptr'] = entry['propagation'].indptr
+            arrays['prop_indices'] = entry['propagation'].indices
+            arrays['prop_data'] = entry['propagation'].data
+            arrays['deg'] = entry['deg']
+        # write to a temporary file first, so that a killed run never leaves a broken cache file
+        tmp_file = self._file(key) + '.tmp.npz'
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, self._file(key))
+
+    def _with_propagation(self, key, entry):
+        if 'propagation' not in entry:
+            add_propagation(entry)
+            if self.cache_dir is not None:
+                self._save(key, entry)
+        return entry
+
+    def key(self, similarity_mat, k, key=None):
+        if key is not None:
+            h = hashlib.blake2b('v{:}_k{:}_{:}_{:}'.format(CACHE_VERSION, k, similarity_mat.shape, key).encode(),
+                                digest_size=20)
+            return h.hexdigest()
+        if self.content_hash:
+            return hash_similarity_mat(similarity_mat, k)
+        return fingerprint_similarity_mat(similarity_mat, k)
+
+    def get(self, similarity_mat, k, propagation=False, key=None):
+        '''
+        :param propagation: the entry must hold the propagation matrix, it is computed (and cached) on first use
+        :param key: name of similarity_mat given by the caller (e.g. 'ref_sm_0'), replaces the fingerprint,
+            the caller has to change it when the matrix changes
+        :return: graph entry of (similarity_mat, k), see build_graph_entry
+        '''
+        key = self.key(similarity_mat, k, key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            return self._with_propagation(key, entry) if propagation else entry
+
+        if self.cache_dir is not None and os.path.exists(self._file(key)):
+            entry = self._load(key)
+            hit = True
+            if propagation:
+                self._with_propagation(key, entry)
+        else:
+            entry = build_graph_entry(similarity_mat, k, propagation)
+            hit = False
+            if self.cache_dir is not None:
+                self._save(key, entry)
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.entries[key] = entry
+            if len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self, disk=False):
+        self.entries.clear()
+        if disk and self.cache_dir is not None:
+            for file in os.listdir(self.cache_dir):
+                if file.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, file))
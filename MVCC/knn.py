@@ -0,0 +1,361 @@
+"""
+    k nearest neighbors index, built once and queried many times
+    backends:
+        exact: sklearn NearestNeighbors (brute force / trees, n_jobs threads), sparse input stays sparse
+        nndescent: approximate, random projection tree start + NN-descent in numpy, near linear in the number of
+            cells, slower than exact on small data (below about 20000 cells, see utils/knn_benchmark.py)
+        hnsw: approximate, hnswlib (optional, pip install hnswlib)
+    the approximate backends reduce sparse input with TruncatedSVD
+
+    usage:
+        index = KNNIndex('nndescent').build(data)
+        A = index.kneighbors_graph(15)          # csr_matrix, cells * cells
+        idx, dist = index.query(new_data, 15)
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from sklearn.decomposition import TruncatedSVD
+from sklearn.neighbors import NearestNeighbors
+from sklearn.preprocessing import normalize
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def _sq_dist(x, x_sq, rows, cands):
+    '''
+    :param x_sq: squared norms of the rows of x
+    :param rows: (b,) indices of x, or the query points themselves (b * d)
+    :param cands: (b * m) candidate indices into x
+    :return: squared euclidean distances (b * m), |q|^2 + |x|^2 - 2 q.x, the only b * m * d array is x[cands]
+    '''
+    q = x[rows] if rows.ndim == 1 else rows
+    q_sq = x_sq[rows] if rows.ndim == 1 else np.einsum('bd,bd->b', q, q)
+    dist = x_sq[cands] + q_sq[:, None] - 2 * np.einsum('bd,bmd->bm', q, x[cands])
+    return np.maximum(dist, 0, out=dist)
+
+
+def _exact_sq_dist(x, rows, idx):
+    '''
+    squared euclidean distances of the final k neighbors, without the cancellation of _sq_dist (near duplicates)
+    '''
+    q = x[rows] if rows.ndim == 1 else rows
+    diff = x[idx] - q[:, None, :]
+    return np.einsum('bkd,bkd->bk', diff, diff)
+
+
+def _top_k_unique(cands, dist, k, self_idx=None):
+    '''
+    keep the k closest distinct candidates of every row
+    :return: idx, dist (b * k), sorted by distance
+    '''
+    order = np.argsort(cands, axis=1, kind='stable')
+    cands = np.take_along_axis(cands, order, axis=1)
+    dist = np.take_along_axis(dist, order, axis=1)
+    dist[:, 1:][cands[:, 1:] == cands[:, :-1]] = np.inf
+    if self_idx is not None:
+        dist[cands == self_idx.reshape(-1, 1)] = np.inf
+    best = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    dist = np.take_along_axis(dist, best, axis=1)
+    cands = np.take_along_axis(cands, best, axis=1)
+    order = np.argsort(dist, axis=1, kind='stable')
+    return np.take_along_axis(cands, order, axis=1), np.take_along_axis(dist, order, axis=1)
+
+
+def _block_top_k(x, x_sq, rows, cands, k, max_bytes):
+    '''
+    k nearest neighbors of rows among cands, all rows against all candidates in one matrix product
+    :param rows: (b,) indices of x, also in cands
+    :param cands: indices of x, may repeat
+    :param max_bytes: cap of the distance matrix, larger ones are computed in row chunks
+    :return: idx, dist (b * k), sorted by distance
+    '''
+    # drop repeats in O(len(cands)), np.unique sorts, stamp maps a cell to its position in cands
+    stamp = np.empty(x.shape[0], dtype=np.int64)
+    pos = np.arange(cands.shape[0])
+    stamp[cands] = pos
+    cands = cands[stamp[cands] == pos]
+    stamp[cands] = np.arange(cands.shape[0])
+    cand_x = x[cands]
+    cand_sq = x_sq[cands]
+    chunk = max(1, int(max_bytes // (4 * cands.shape[0])))
+    idx = np.empty((rows.shape[0], k), dtype=np.int64)
+    dist = np.empty((rows.shape[0], k), dtype=np.float32)
+    for start in range(0, rows.shape[0], chunk):
+        part = rows[start:start + chunk]
+        d = x_sq[part].reshape(-1, 1) + cand_sq - 2 * (x[part] @ cand_x.T)
+        d[np.arange(part.shape[0]), stamp[part]] = np.inf
+        best = np.argpartition(d, k - 1, axis=1)[:, :k]
+        d = np.take_along_axis(d, best, axis=1)
+        order = np.argsort(d, axis=1, kind='stable')
+        idx[start:start + chunk] = np.take_along_axis(cands[best], order, axis=1)
+        dist[start:start + chunk] = np.maximum(np.take_along_axis(d, order, axis=1), 0)
+    return idx, dist
+
+
+def _rp_order(x, leaf_size, rng):
+    '''
+    order of the cells along a random projection tree, every node splits its cells at the median of their projection
+    on the difference of two random cells of the node, until the nodes hold at most leaf_size cells
+    :return: permutation of the cells, the cells of every subtree are consecutive
+    '''
+    n = x.shape[0]
+    order = np.arange(n)
+    bounds = np.array([0, n])
+    while np.diff(bounds).max() > leaf_size:
+        starts, sizes = bounds[:-1], np.diff(bounds)
+        a = order[starts + (rng.random(starts.shape[0]) * sizes).astype(np.int64)]
+        b = order[starts + (rng.random(starts.shape[0]) * sizes).astype(np.int64)]
+        node = np.repeat(np.arange(starts.shape[0]), sizes)
+        proj = np.einsum('nd,nd->n', x[order], (x[a] - x[b])[node])
+        order = order[np.lexsort((proj, node))]
+        bounds = np.unique(np.concatenate([bounds, starts + sizes // 2]))
+    return order
+
+
+def _reverse_neighbors(idx, rng):
+    '''
+    :param idx: neighbors (cells * k)
+    :return: (cells * k) random sample of the cells that have each cell as a neighbor, padded with -1
+    '''
+    n, k = idx.shape
+    rev = np.full((n, k), -1, dtype=np.int64)
+    src = np.repeat(np.arange(n), k)
+    dst = idx.reshape(-1)
+    perm = rng.permutation(src.shape[0])
+    src, dst = src[perm], dst[perm]
+    order = np.argsort(dst, kind='stable')
+    src, dst = src[order], dst[order]
+    pos = np.arange(dst.shape[0]) - np.searchsorted(dst, dst)
+    keep = pos < k
+    rev[dst[keep], pos[keep]] = src[keep]
+    return rev
+
+
+class KNNIndex(object):
+    def __init__(self, method='exact', metric='euclidean', n_jobs=None, n_iters=10, delta=0.001,
+                 block_size=128, n_trees=2, seed=0, ef=100, m=16, max_memory_mb=512, n_components=50):
+        '''
+        :param method: 'exact', 'nndescent' or 'hnsw'
+        :param metric: 'euclidean' or 'cosine'
+        :param n_jobs: threads, None means all cores
+        :param n_iters: max iterations of nndescent (also of its query search)
+        :param delta: nndescent stops once fewer than delta * n * k neighbors change in an iteration
+        :param block_size: cells scored together by nndescent, against the union of their candidates in one matrix
+            product (the cells of a block are close in a random projection tree, so their candidates overlap)
+        :param n_trees: random projection trees of the nndescent initial graph
+        :param max_memory_mb: cap of the distances / candidate vectors held at once by nndescent over all threads,
+            blocks get smaller for high dimensional data
+        :param ef, m: hnswlib construction / search parameters
+        :param n_components: sparse input of nndescent / hnsw is reduced to this many TruncatedSVD components
+            (exact keeps it sparse), None densifies it
+        '''
+        assert method in ['exact', 'nndescent', 'hnsw']
+        assert metric in ['euclidean', 'cosine']
+        if method == 'hnsw' and hnswlib is None:
+            raise ImportError("method 'hnsw' needs hnswlib, pip install hnswlib")
+        self.method = method
+        self.metric = metric
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.n_iters = n_iters
+        self.delta = delta
+        self.block_size = block_size
+        self.n_trees = n_trees
+        self.seed = seed
+        self.ef = ef
+        self.m = m
+        self.max_memory_mb = max_memory_mb
+        self.n_components = n_components
+        self.svd = None
+        self.data = None
+        self.sq_norms = None
+        self.index = None
+        self.graph = None
+
+    def _prepare(self, data, fit=False):
+        '''
+        :param fit: data is the indexed data, fits the TruncatedSVD of sparse input
+        '''
+        if sp.issparse(data):
+            data = sp.csr_matrix(data, dtype=np.float32)
+            if self.metric == 'cosine':
+                data = normalize(data)
+            if self.method == 'exact':
+                return data
+            if self.n_components is not None and data.shape[1] > self.n_components:
+                if fit:
+                    self.svd = TruncatedSVD(self.n_components, random_state=self.seed).fit(data)
+                data = self.svd.transform(data)
+            else:
+                data = data.toarray()
+        data = np.asarray(data, dtype=np.float32)
+        if self.metric == 'cosine':
+            data = normalize(data)
+        return np.ascontiguousarray(data)
+
+    def _rows_per_block(self, n_cands):
+        '''
+        :param n_cands: candidates scored per cell
+        :return: cells per block, so that the gathered candidate vectors (float32) of all threads fit max_memory_mb
+        '''
+        bytes_per_row = 4 * n_cands * self.data.shape[1] * self.n_jobs
+        return max(1, min(self.block_size, int(self.max_memory_mb * (1 << 20) // bytes_per_row)))
+
+    def _map_blocks(self, func, n, block_size):
+        '''
+        :param func: called with (start, stop) of every block
+        '''
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+            return list(pool.map(lambda start: func(start, min(start + block_size, n)), range(0, n, block_size)))
+
+    def build(self, data, k=15):
+        '''
+        :param data: ndarray or scipy.sparse matrix (cells * features)
+        :param k: neighbors kept per cell by the nndescent graph, at least 15 (queries with more neighbors re-run it)
+        :return: self
+        '''
+        self.data = self._prepare(data, fit=True)
+        if self.method == 'exact':
+            self.index = NearestNeighbors(n_jobs=self.n_jobs).fit(self.data)
+        elif self.method == 'hnsw':
+            self.index = hnswlib.Index(space='l2', dim=self.data.shape[1])
+            self.index.init_index(max_elements=self.data.shape[0], ef_construction=self.ef, M=self.m)
+            self.index.add_items(self.data, num_threads=self.n_jobs)
+            self.index.set_ef(self.ef)
+        else:
+            self.sq_norms = np.einsum('nd,nd->n', self.data, self.data)
+            # small k descents converge badly, keep at least 15 neighbors and cut later
+            self.graph = self._nn_descent(max(k, 15))
+        return self
+
+    def _nn_descent(self, k):
+        x = self.data
+        n = x.shape[0]
+        k = min(k, n - 1)
+        rng = np.random.default_rng(self.seed)
+        x_sq = self.sq_norms
+        max_bytes = self.max_memory_mb * (1 << 20) / self.n_jobs
+        block_size = max(self.block_size, k + 1)
+
+        # initial neighbors: within windows of block_size consecutive cells of random projection trees
+        def init(order):
+            def window(start, stop):
+                first = max(0, min(start, n - block_size))
+                return _block_top_k(x, x_sq, order[start:stop], order[first:first + block_size], k, max_bytes)
+            blocks = self._map_blocks(window, n, block_size)
+            inverse = np.argsort(order)
+            return np.vstack([b[0] for b in blocks])[inverse], np.vstack([b[1] for b in blocks])[inverse]
+
+        orders = [_rp_order(x, block_size, rng) for _ in range(self.n_trees)]
+        trees = [init(order) for order in orders]
+        idx, dist = _top_k_unique(np.hstack([t[0] for t in trees]), np.hstack([t[1] for t in trees]), k)
+        # the descent goes through the cells in tree order, the candidates of a block then overlap
+        order = orders[0]
+
+        for it in range(self.n_iters):
+            rev = _reverse_neighbors(idx, rng)
+
+            def update(start, stop):
+                rows = order[start:stop]
+                # forward and reverse neighbors, and their forward neighbors
+                near = np.concatenate([idx[rows], rev[rows]], axis=1).reshape(-1)
+                near = near[near >= 0]
+                cands = np.concatenate([rows, near, idx[near].reshape(-1)])
+                new_idx, new_dist = _block_top_k(x, x_sq, rows, cands, k, max_bytes)
+                changed = int((np.sort(new_idx, axis=1) != np.sort(idx[rows], axis=1)).sum())
+                return new_idx, new_dist, changed
+
+            blocks = self._map_blocks(update, n, block_size)
+            inverse = np.argsort(order)
+            idx = np.vstack([b[0] for b in blocks])[inverse]
+            dist = np.vstack([b[1] for b in blocks])[inverse]
+            changed = sum(b[2] for b in blocks)
+            if changed < self.delta * n * k:
+                break
+        dist = np.vstack(self._map_blocks(lambda start, stop: _exact_sq_dist(x, np.arange(start, stop),
+                                                                             idx[start:stop]),
+                                          n, self._rows_per_block(k)))
+        return idx, dist
+
+    def query(self, queries=None, k=15):
+        '''
+        :param queries: ndarray or scipy.sparse matrix (cells * features), None queries the indexed cells
+            themselves (a cell is then not its own neighbor)
+        :return: idx, dist (cells * k), sorted by distance (euclidean, or of the normalized vectors for cosine)
+        '''
+        self_query = queries is None
+        q = self.data if self_query else self._prepare(queries)
+        n = self.data.shape[0]
+        k_query = min(k, n - 1) if self_query else min(k, n)
+
+        if self.method == 'exact':
+            if self_query:
+                dist, idx = self.index.kneighbors(n_neighbors=k_query)
+            else:
+                dist, idx = self.index.kneighbors(q, n_neighbors=k_query)
+            return idx, dist
+
+        if self.method == 'hnsw':
+            idx, dist = self.index.knn_query(q, k=k_query + 1 if self_query else k_query, num_threads=self.n_jobs)
+            idx = idx.astype(np.int64)
+            if self_query:
+                # drop the cell itself (or the farthest one if it was not returned)
+                is_self = idx == np.arange(n).reshape(-1, 1)
+                is_self[~is_self.any(axis=1), -1] = True
+                idx = idx[~is_self].reshape(n, k_query)
+                dist = dist[~is_self].reshape(n, k_query)
+            return idx, np.sqrt(dist)
+
+        if self.graph is None or self.graph[0].shape[1] < k_query:
+            self.graph = self._nn_descent(k_query)
+        if self_query:
+            return self.graph[0][:, :k_query], np.sqrt(self.graph[1][:, :k_query])
+        return self._search(q, k_query)
+
+    def _search(self, q, k):
+        '''
+        greedy graph search of new points: start from the k best of a random sample of cells, then repeatedly move to the
+        neighbors of the current k best
+        '''
+        x = self.data
+        n = x.shape[0]
+        rng = np.random.default_rng(self.seed)
+        # follow the edges both ways, cells that are nobody's neighbor can still be reached
+        graph = np.concatenate([self.graph[0], _reverse_neighbors(self.graph[0], rng)], axis=1)
+        graph = np.where(graph < 0, self.graph[0][:, :1], graph)
+
+        # enough random starts to land near every point, also when the graph falls apart into clusters
+        starts = rng.choice(n, size=min(n, max(256, 4 * int(np.sqrt(n)), k)), replace=False)
+
+        x_sq = self.sq_norms
+
+        def search(start, stop):
+            points = q[start:stop]
+            idx = np.broadcast_to(starts, (stop - start, starts.shape[0]))
+            idx, dist = _top_k_unique(idx, _sq_dist(x, x_sq, points, idx), k)
+            for it in range(self.n_iters):
+                cands = np.concatenate([idx, graph[idx].reshape(stop - start, -1)], axis=1)
+                new_idx, new_dist = _top_k_unique(cands, _sq_dist(x, x_sq, points, cands), k)
+                if (new_idx == idx).all():
+                    break
+                idx, dist = new_idx, new_dist
+            return idx, np.sqrt(_exact_sq_dist(x, points, idx))
+
+        block_size = self._rows_per_block(max(starts.shape[0], k * (1 + graph.shape[1])))
+        blocks = self._map_blocks(search, q.shape[0], block_size)
+        return np.vstack([b[0] for b in blocks]), np.vstack([b[1] for b in blocks])
+
+    def kneighbors_graph(self, k, mode='connectivity'):
+        '''
+        kNN graph of the indexed cells, like sklearn kneighbors_graph(include_self=False)
+        :param mode: 'connectivity' (1) or 'distance'
+        :return: csr_matrix (cells * cells), row i holds the k neighbors of cell i
+        '''
+        idx, dist = self.query(None, k)
+        n = self.data.shape[0]
+        values = np.ones(idx.size) if mode == 'connectivity' else dist.reshape(-1)
+        return sp.csr_matrix((values, (np.repeat(np.arange(n), idx.shape[1]), idx.reshape(-1))), shape=(n, n))
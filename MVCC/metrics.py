@@ -0,0 +1,130 @@
+"""
+    evaluation metrics on integer-encoded labels, every metric is one vectorised pass
+    (bincount over label pairs), plotting is a separate, optional step (plot_matrix)
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def encode_labels(labels, classes=None, lower=False):
+    '''
+    :param labels: array of labels
+    :param classes: sorted array of the known labels, None takes the sorted unique labels
+    :param lower: compare labels in lower case
+    :return: classes, codes (index of every label in classes)
+    '''
+    labels = np.asarray(labels).reshape(-1)
+    if lower:
+        labels = np.char.lower(labels.astype(str))
+    if classes is None:
+        classes, codes = np.unique(labels, return_inverse=True)
+        return classes, codes
+    classes = np.asarray(classes)
+    codes = np.searchsorted(classes, labels)
+    unknown = (codes >= classes.shape[0]) | (classes[np.minimum(codes, classes.shape[0] - 1)] != labels)
+    if unknown.any():
+        raise KeyError("labels not in classes: {:}".format(sorted(set(labels[unknown].tolist()))))
+    return classes, codes
+
+
+def confusion_matrix(true_codes, pred_codes, n_true, n_pred=None):
+    '''
+    :return: ndarray (n_true * n_pred), [i, j] is the number of cells of true class i predicted as j
+    '''
+    n_pred = n_true if n_pred is None else n_pred
+    return np.bincount(true_codes * n_pred + pred_codes, minlength=n_true * n_pred).reshape(n_true, n_pred)
+
+
+def class_metrics(true, pred, classes=None, lower=False):
+    '''
+    :param true, pred: labels (cells)
+    :param classes: sorted labels, None takes the sorted union of true and pred
+    :return: dict
+        classes, confusion (classes * classes),
+        accuracy, per_class_accuracy (recall of every class, nan for classes without cells),
+        precision, f1 (per class), macro_f1 (over the classes present in true)
+    '''
+    true = np.asarray(true).reshape(-1)
+    pred = np.asarray(pred).reshape(-1)
+    if classes is None:
+        classes, codes = encode_labels(np.concatenate([true, pred]), lower=lower)
+        true_codes, pred_codes = codes[:true.shape[0]], codes[true.shape[0]:]
+    else:
+        classes, true_codes = encode_labels(true, classes, lower=lower)
+        _, pred_codes = encode_labels(pred, classes, lower=lower)
+    confusion = confusion_matrix(true_codes, pred_codes, classes.shape[0])
+
+    tp = np.diag(confusion).astype(np.float64)
+    n_true = confusion.sum(axis=1)
+    n_pred = confusion.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recall = tp / n_true
+        precision = np.where(n_pred > 0, tp / np.maximum(n_pred, 1), 0)
+        f1 = np.where(tp > 0, 2 * tp / (n_true + n_pred), 0)
+    return {
+        'classes': classes,
+        'confusion': confusion,
+        'accuracy': tp.sum() / max(true.shape[0], 1),
+        'per_class_accuracy': recall,
+        'precision': precision,
+        'f1': f1,
+        'macro_f1': f1[n_true > 0].mean() if (n_true > 0).any() else 0.0,
+    }
+
+
+def neighborhood_counts(adjacency, codes, n_classes):
+    '''
+    :param adjacency: scipy.sparse matrix (cells * cells), e.g. the MNN graph
+    :param codes: integer labels (cells)
+    :return: ndarray (n_classes * n_classes), [i, j] is the total edge weight from cells of class i to cells of class j
+    '''
+    adjacency = sp.coo_matrix(adjacency)
+    pair = codes[adjacency.row] * n_classes + codes[adjacency.col]
+    return np.bincount(pair, weights=adjacency.data, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+
+def neighborhood_purity(adjacency, labels):
+    '''
+    :return: dict
+        classes, counts (see neighborhood_counts),
+        cell_purity: fraction of the edge weight of every cell that goes to its own class (nan without edges),
+        class_purity: fraction of the edge weight of every class that stays inside it
+    '''
+    classes, codes = encode_labels(labels)
+    adjacency = sp.csr_matrix(adjacency)
+    counts = neighborhood_counts(adjacency, codes, classes.shape[0])
+    coo = adjacency.tocoo()
+    same = np.bincount(coo.row, weights=coo.data * (codes[coo.row] == codes[coo.col]), minlength=adjacency.shape[0])
+    total = np.asarray(adjacency.sum(axis=1)).reshape(-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cell_purity = same / total
+        class_purity = np.diag(counts) / counts.sum(axis=1)
+    return {
+        'classes': classes,
+        'counts': counts,
+        'cell_purity': cell_purity,
+        'class_purity': class_purity,
+    }
+
+
+def row_normalize(matrix):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return matrix / matrix.sum(axis=1).reshape(-1, 1)
+
+
+def plot_matrix(matrix, row_names, col_names, save_name, cbar=True, dpi=300, reverse_rows=False):
+    '''
+    heatmap of a (normalized) confusion / neighborhood matrix
+    '''
+    # plotting libraries are only needed here
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    data_df = pd.DataFrame(matrix, index=row_names, columns=col_names)
+    if reverse_rows:
+        data_df = data_df.reindex(index=data_df.index[::-1])
+    sns.heatmap(data=data_df, cmap="Blues", cbar=cbar, xticklabels=True, yticklabels=True)
+    plt.savefig(save_name, dpi=dpi, bbox_inches="tight")
+    plt.clf()
+    return data_df
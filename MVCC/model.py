@@ -1,22 +1,70 @@
 import os.path
 import random
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import sklearn
 from re import X
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 import torch.nn as nn
 import torch
 from torch_geometric.nn import GCNConv
 import torch.nn.functional as F
 import torch.optim as optim
-from MVCC.util import cpm_classify, mask_data, construct_graph, z_score_scale, construct_graph_with_knn, mask_column, \
-    mask_cells
+from MVCC.util import cpm_classify, construct_graph, z_score_scale, construct_graph_with_knn, mask_column, \
+    mask_cells, DataMasker, to_torch_sparse, stratified_batches, H5Matrix, ClassPrototypes
+from MVCC.graph_cache import build_graph_entry
 from MVCC.classifiers import FocalLoss, GCNClassifier, FCClassifier, CNNClassifier, FCClassifier2
 from sklearn.decomposition import PCA
 import random
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 # device = 'cpu'
+
+
+def get_propagation(sm_mat, k, graph_cache=None):
+    '''
+    :return: csr_matrix D^-1/2 (A + I) D^-1/2 of the MNN graph of (sm_mat, k)
+    '''
+    if graph_cache is not None:
+        return graph_cache.get(sm_mat, k, propagation=True)['propagation']
+    return build_graph_entry(sm_mat, k, propagation=True)['propagation']
+
+
+def _read_rows(data, rows, genes=None, row_scale=None):
+    '''
+    :param data: ndarray, scipy.sparse matrix or H5Matrix (cells * genes)
+    :param rows: sorted ndarray of cell indices
+    :param genes: sorted ndarray of gene indices, None keeps all genes
+    :param row_scale: factor of every cell (cells,), None keeps the rows as they are
+    :return: float tensor of the rows on the host, sparse COO if data is sparse
+    '''
+    if isinstance(data, H5Matrix):
+        block = data.read(rows, cols=genes)
+    else:
+        block = data[rows]
+        if genes is not None:
+            block = block[:, genes]
+    if row_scale is not None:
+        block = sp.diags(row_scale[rows]) @ block if sp.issparse(block) else block * row_scale[rows].reshape(-1, 1)
+    if sp.issparse(block):
+        return to_torch_sparse(block)
+    return torch.from_numpy(np.asarray(block, dtype=np.float32))
+
+
+def _masked_entries_by_row(masker, n_cells, n_genes):
+    '''
+    :return: rows_ptr, cols, target: masked entries sorted by cell,
+        the entries of cell i are cols[rows_ptr[i]:rows_ptr[i + 1]]
+    '''
+    mask_idx = masker.mask_idx.cpu().numpy()
+    rows, cols = np.divmod(mask_idx, n_genes)
+    order = np.argsort(rows, kind='stable')
+    rows_ptr = np.searchsorted(rows[order], np.arange(n_cells + 1))
+    return rows_ptr, cols[order], masker.target.cpu().numpy()[order]
+
 class CPMNets(torch.nn.Module):
     def __init__(self,
                  view_num,
@@ -32,34 +80,25 @@ class CPMNets(torch.nn.Module):
 
         self.view_num = view_num
         self.lsd = lsd        
+        self.classifier_name = classifier_name
+        self.classifier_hidden_units = classifier_hidden_units
         self.view_dim = [view_dim for i in range(view_num)]
         # model save path
         self.save_path = save_path
         # input of net is representation h ---> reconstructs to X
-        # reconstruction net
-        self.net = []
+        # reconstruction net, the decoders of all views fused into one linear layer,
+        # view i is reconstructed in columns view_slices[i] of the concatenated views
+        self.net = nn.Linear(self.lsd, sum(self.view_dim), device=device)
         self.ref_h = None
         self.ref_labels = None
         self.query_h = None
         self.scaler = None
+        # optional encoder views ---> h, see train_encoder
+        self.encoder = None
+        # thread writing classifier.pt, see wait_saved
+        self.classifier_save = None
 
-        self.view_idx = [[i + sum(self.view_dim[:j]) for i in range(self.view_dim[j])] for j in range(self.view_num)]
-
-        # self.classifiers = []
-        for i in range(view_num):
-            self.net.append(
-                nn.Sequential(
-                    nn.Linear(self.lsd, self.view_dim[i], device=device),
-                    # nn.ReLU(),
-                    # nn.Dropout(0.4),
-                    # nn.Linear(800, self.view_dim[i], device=device),
-                )
-            )
-
-            # nn.init.xavier_uniform_(self.net[i][0].weight)
-            # nn.init.xavier_uniform_(self.net[i][0].bias)
-
-
+        self.view_slices = [slice(sum(self.view_dim[:j]), sum(self.view_dim[:j + 1])) for j in range(self.view_num)]
 
         self.class_num = class_num
 
@@ -73,74 +112,105 @@ class CPMNets(torch.nn.Module):
             self.classifier = FCClassifier2(self.lsd, self.class_num)
         self.classifier = self.classifier.to(device)
 
+    def wait_saved(self):
+        '''
+        wait until classifier.pt (written in the background by train_classifier) is on disk
+        '''
+        thread = getattr(self, 'classifier_save', None)
+        if thread is not None:
+            thread.join()
+            self.classifier_save = None
+
+    def __getstate__(self):
+        # the saving thread can not be pickled
+        self.wait_saved()
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        # models saved before the decoders were fused keep a list of per-view nn.Sequential(nn.Linear)
+        if isinstance(state.get('net'), list):
+            decoders = [net[0] for net in state.pop('net')]
+            fused = nn.Linear(decoders[0].in_features, sum(d.out_features for d in decoders),
+                              device=decoders[0].weight.device)
+            with torch.no_grad():
+                fused.weight.copy_(torch.cat([d.weight for d in decoders], dim=0))
+                fused.bias.copy_(torch.cat([d.bias for d in decoders], dim=0))
+            state['_modules']['net'] = fused
+            view_idx = state.pop('view_idx')
+            state['view_slices'] = [slice(idx[0], idx[-1] + 1) for idx in view_idx]
+        if 'encoder' not in state and 'encoder' not in state['_modules']:
+            state['encoder'] = None
+        super(CPMNets, self).__setstate__(state)
+
     def reconstrution_loss(self, r_x, x):    
         return ((r_x - x) ** 2).sum()
 
-    def class_loss(self, h, gt):
+    def label_onehot(self, gt):
+        '''
+        :param gt: labels (n)
+        :return: one-hot of gt (n * class_num), class_num = max(gt) - min(gt) + 1
+        '''
+        class_num = torch.max(gt).item() - torch.min(gt).item() + 1  # class数量
+        label_onehot = torch.zeros((gt.shape[0], class_num), device=gt.device)
+        # gt = gt - 1  # 因为这里我的labels是从1开始的，矩阵从0开始，减1避免越界
+        label_onehot.scatter_(dim=1, index=gt.view(-1, 1), value=1)  # 得到各个样本分类的one-hot表示
+        return label_onehot
+
+    def class_loss(self, h, gt, label_onehot=None, chunk_size=None):
         '''
         :param gt: ground truth labels (including training data),
 
         :param h: latent representation
-        :param len:
+        :param label_onehot: label_onehot(gt), pass it to avoid rebuilding it every epoch
+        :param chunk_size: number of cells evaluated at a time, None evaluates all cells at once
         :return: loss
         '''
-        F_h_h = torch.mm(h, h.t())
-        F_hn_hn = torch.diag(F_h_h)
-        F_h_h = F_h_h - torch.diag_embed(F_hn_hn)  # 将F_h_h对角线部分置0
-        class_num = torch.max(gt).item() - torch.min(gt).item() + 1  # class数量
-        # label_onehot = torch.zeros((h.shape[0], self.class_num)).to(device)
-
-        label_onehot = torch.zeros((h.shape[0], class_num)).to(device)
-        # gt = gt - 1  # 因为这里我的labels是从1开始的，矩阵从0开始，减1避免越界
-
-        label_onehot.scatter_(dim=1, index=gt.view(-1, 1), value=1)  # 得到各个样本分类的one-hot表示
+        # sum_{j in class c, j != i} h_i . h_j = h_i . S_c - [gt_i == c] |h_i|^2, S_c = sum_{j in class c} h_j
+        # same as (h h^T with zero diagonal) @ onehot, without the n*n matrix
+        if label_onehot is None:
+            label_onehot = self.label_onehot(gt)
         label_num = torch.sum(label_onehot, dim=0)  # 得到每个label的样本数
-        F_h_h_sum = torch.mm(F_h_h, label_onehot)
         label_num[torch.where(label_num == 0)] = 1  # 这里要排除掉为分母为0的风险(transfer across species里面有这种情况)
+        class_sum = torch.mm(label_onehot.t(), h)  # class_num * d
+        h_norm = torch.sum(h * h, dim=1, keepdim=True)
 
-        F_h_h_mean = F_h_h_sum / label_num  # 自动广播
-        gt_ = torch.argmax(F_h_h_mean, dim=1)  # 获得每个样本预测的类别
-        F_h_h_mean_max = torch.max(F_h_h_mean, dim=1)[0]  # 取到每个样本的最大值 1*n
-
-        theta = torch.not_equal(gt, gt_).view(1, -1)
-        F_h_hn_mean_ = torch.mul(F_h_h_mean, label_onehot)
-        F_h_hn_mean = torch.sum(F_h_hn_mean_, dim=1)  # 1*n
-
-        return torch.sum(F.relu(theta + (F_h_h_mean_max - F_h_hn_mean)))
+        n = h.shape[0]
+        if chunk_size is None:
+            chunk_size = n
+        loss = 0
+        for start in range(0, n, chunk_size):
+            onehot = label_onehot[start:start + chunk_size]
+            F_h_h_sum = torch.mm(h[start:start + chunk_size], class_sum.t()) - onehot * h_norm[start:start + chunk_size]
 
-    def fisher_loss(self, h, gt):        
-        label_list = list(set(np.array(gt.cpu()).reshape(-1).tolist()))
-        idx = []  # 存储每一个类别所在行数
+            F_h_h_mean = F_h_h_sum / label_num  # 自动广播
+            gt_ = torch.argmax(F_h_h_mean, dim=1)  # 获得每个样本预测的类别
+            F_h_h_mean_max = torch.max(F_h_h_mean, dim=1)[0]  # 取到每个样本的最大值 1*n
 
-        for label in label_list:
-            idx.append(torch.where(gt == label)[0])
+            theta = torch.not_equal(gt[start:start + chunk_size], gt_)
+            F_h_hn_mean = torch.sum(torch.mul(F_h_h_mean, onehot), dim=1)  # 1*n
 
-        v_arr = []
-        u_arr = []
-        for i in range(len(idx)):
-            data = h[idx[i], :]
+            loss = loss + torch.sum(F.relu(theta + (F_h_h_mean_max - F_h_hn_mean)))
+        return loss
 
-            u = torch.mean(data, dim=0, dtype=torch.float64)
-
-            v_arr.append((torch.diag(torch.mm(data - u, (data - u).T)).sum()).view(1, -1))
-            u_arr.append(u.reshape(1, -1))
-
-        Sw = torch.cat(v_arr, dim=1).sum()
+    def fisher_loss(self, h, gt):
+        '''
+        within-class scatter / between-class scatter, all classes at once
+        :param gt: labels (n), in [0, class_num) (checked by MVCCModel.fit)
+        '''
+        h = h.double()
+        gt = gt.view(-1)
+        n_class = self.class_num
+        # m 记录每个类的数目, u 每个类的均值
+        m = torch.zeros(n_class, dtype=h.dtype, device=h.device).index_add_(
+            0, gt, torch.ones(gt.shape[0], dtype=h.dtype, device=h.device))
+        u = torch.zeros((n_class, h.shape[1]), dtype=h.dtype, device=h.device).index_add_(0, gt, h)
+        u = u / m.clamp(min=1).view(-1, 1)
 
-        # m 记录每个类的数目
-        m = []
-        for i in range(len(idx)):
-            m.append(len(idx[i]))
+        Sw = ((h - u[gt]) ** 2).sum()
 
-        data_u = torch.mean(h, dim=0, dtype=torch.float64)
-        u_tensor = torch.cat(u_arr, dim=0)
+        data_u = torch.mean(h, dim=0)
+        Sb = (m * ((u - data_u) ** 2).sum(dim=1)).sum()
 
-        Sb = torch.mm(u_tensor - data_u, (u_tensor - data_u).T)
-        Sb = torch.diag(Sb).view(1, -1)
-        m_tensor = torch.FloatTensor(m).view(1, -1).to(device)
-        Sb = torch.mul(Sb, m_tensor)
-        Sb = Sb.sum()
-        
         return Sw / Sb
 
     def train_ref_h(self,
@@ -154,20 +224,34 @@ class CPMNets(torch.nn.Module):
                     test_size=0.2,
                     lamb=500,
                     exp_mode=1,
+                    class_loss_chunk_size=None,
+                    batch_size_cpm=None,
+                    epochs_encoder=0,
                     ):
 
         '''
         update net, h and classifier                
+        :param class_loss_chunk_size: cells per chunk of class_loss, None evaluates all cells at once
+        :param batch_size_cpm: train net and h on class-stratified mini-batches of this size (see train_ref_h_minibatch),
+            None trains on all cells at once
+        :param epochs_encoder: > 0 also trains the encoder views ---> h for this many epochs (see train_encoder)
         '''
         
-        net_params = []
-        for i in range(self.view_num):
-            for p in self.net[i].parameters():
-                net_params.append(p)
+        net_params = list(self.net.parameters())
 
         # split into training and validation data
         train_data = ref_data
         train_label = ref_label.view(-1)
+        train_label_onehot = self.label_onehot(train_label)
+
+        if batch_size_cpm is not None:
+            train_h = self.train_ref_h_minibatch(train_data, train_label, train_label_onehot, epochs_cpm_ref,
+                                                 batch_size_cpm, lamb=lamb, exp_mode=exp_mode,
+                                                 class_loss_chunk_size=class_loss_chunk_size)
+            if epochs_encoder > 0:
+                self.train_encoder(train_data, train_h, epochs_encoder)
+            return self.train_classifier_on_h(train_h, train_label, batch_size_classifier, epochs_classifier,
+                                              patience_for_classifier, test_size)
         
         # print(labels.shape)
         train_h = torch.zeros((train_data.shape[0], self.lsd), dtype=torch.float).to(device)        
@@ -181,21 +265,16 @@ class CPMNets(torch.nn.Module):
 
         # multi ref        
         if exp_mode == 2:
-            for i in range(self.view_num):
-                for param in self.net[i].parameters():
-                    param.requires_grad = False
+            for param in self.net.parameters():
+                param.requires_grad = False
             for epoch in range(10):
-                r_loss = 0
-                for i in range(self.view_num):
-                    r_loss += self.reconstrution_loss(self.net[i](train_h),
-                                                      train_data[:, self.view_idx[i]])
+                r_loss = self.reconstrution_loss(self.net(train_h), train_data)
                 optimizer_for_train_h.zero_grad()
                 r_loss.backward()
                 optimizer_for_train_h.step()
             
 
-        for i in range(self.view_num):
-            self.net[i].train()
+        self.net.train()
 
         min_c_loss = 99999999
         min_c_loss_train_h = None
@@ -208,14 +287,10 @@ class CPMNets(torch.nn.Module):
         for epoch in range(epochs_cpm_ref):
             # update net
             train_h.requires_grad = False
-            for i in range(self.view_num):
-                for param in self.net[i].parameters():
-                    param.requires_grad = True
+            for param in self.net.parameters():
+                param.requires_grad = True
 
-            r_loss = 0
-            for i in range(self.view_num):
-                r_loss += self.reconstrution_loss(self.net[i](train_h),
-                                                  train_data[:, self.view_idx[i]])
+            r_loss = self.reconstrution_loss(self.net(train_h), train_data)
             # r_loss /= train_h.shape[0]
             optimizer_for_net.zero_grad()
             r_loss.backward()
@@ -223,16 +298,12 @@ class CPMNets(torch.nn.Module):
 
             # update h
             train_h.requires_grad = True
-            for i in range(self.view_num):
-                for param in self.net[i].parameters():
-                    param.requires_grad = False
+            for param in self.net.parameters():
+                param.requires_grad = False
 
-            r_loss = 0
-            for i in range(self.view_num):
-                r_loss += self.reconstrution_loss(self.net[i](train_h),
-                                                  train_data[:, self.view_idx[i]])
+            r_loss = self.reconstrution_loss(self.net(train_h), train_data)
 
-            c_loss = self.class_loss(train_h, train_label)
+            c_loss = self.class_loss(train_h, train_label, train_label_onehot, class_loss_chunk_size)
             # c_loss += self.fisher_loss(train_h, train_label)
             total_loss = r_loss + lamb * c_loss
 
@@ -247,13 +318,132 @@ class CPMNets(torch.nn.Module):
 
             
 
+        train_h.requires_grad = False
+        if epochs_encoder > 0:
+            self.train_encoder(train_data, train_h, epochs_encoder)
+        return self.train_classifier_on_h(train_h, train_label, batch_size_classifier, epochs_classifier,
+                                          patience_for_classifier, test_size)
+
+    def train_ref_h_minibatch(self,
+                              train_data,
+                              train_label,
+                              train_label_onehot,
+                              epochs_cpm_ref,
+                              batch_size,
+                              lamb=500,
+                              exp_mode=1,
+                              class_loss_chunk_size=None,
+                              seed=0,
+                              ):
         '''
-            classifier training
+        mini-batch version of the net / h updates of train_ref_h,
+        h of every cell is a row of a sparse embedding table, so a step only touches the rows of its batch
+        :param train_data: concatenated views (cells * sum(view_dim)), may stay on the host, batches are moved to device
+        :param batch_size: cells per batch, batches keep the class proportions so that class_loss stays meaningful
+        :return: h (cells * lsd) on device
         '''
-        train_h.requires_grad = False
-        for i in range(self.view_num):
-            for param in self.net[i].parameters():
+        h_table = nn.Embedding(train_data.shape[0], self.lsd, sparse=True, device=device)
+        # h initialization
+        nn.init.xavier_uniform_(h_table.weight)
+
+        optimizer_for_net = optim.Adam(params=self.net.parameters())
+        optimizer_for_train_h = optim.SparseAdam(params=h_table.parameters())
+
+        rng = np.random.default_rng(seed)
+        label_numpy = train_label.cpu().numpy()
+
+        def h_step(batch, use_class_loss=True):
+            batch_idx = torch.from_numpy(batch).to(device)
+            h = h_table(batch_idx)
+            r_loss = self.reconstrution_loss(self.net(h), train_data[batch_idx.to(train_data.device)].to(device))
+            c_loss = self.class_loss(h, train_label[batch_idx], train_label_onehot[batch_idx], class_loss_chunk_size) \
+                if use_class_loss else torch.zeros(1, device=device)
+            optimizer_for_train_h.zero_grad()
+            (r_loss + lamb * c_loss).backward()
+            optimizer_for_train_h.step()
+            return r_loss, c_loss
+
+        # multi ref
+        if exp_mode == 2:
+            for param in self.net.parameters():
                 param.requires_grad = False
+            for epoch in range(10):
+                for batch in stratified_batches(label_numpy, batch_size, rng):
+                    h_step(batch, use_class_loss=False)
+
+        self.net.train()
+        for epoch in range(epochs_cpm_ref):
+            r_loss_sum = 0
+            c_loss_sum = 0
+            for batch in stratified_batches(label_numpy, batch_size, rng):
+                # update net
+                for param in self.net.parameters():
+                    param.requires_grad = True
+                batch_idx = torch.from_numpy(batch).to(device)
+                r_loss = self.reconstrution_loss(self.net(h_table(batch_idx).detach()),
+                                                 train_data[batch_idx.to(train_data.device)].to(device))
+                optimizer_for_net.zero_grad()
+                r_loss.backward()
+                optimizer_for_net.step()
+
+                # update h
+                for param in self.net.parameters():
+                    param.requires_grad = False
+                r_loss, c_loss = h_step(batch)
+                r_loss_sum += r_loss.detach()
+                c_loss_sum += c_loss.detach()
+
+            if epoch % 100 == 0:
+                print(
+                    'epoch %d: Reconstruction loss = %.3f, classification loss = %.3f.' % (
+                        epoch, float(r_loss_sum), float(c_loss_sum)))
+
+        return h_table.weight.detach()
+
+    def train_encoder(self, train_data, train_h, epochs, batch_size=256, lr=1e-3, hidden_units=128):
+        '''
+        fit an MLP from the concatenated views to the trained h,
+        train_query_h can then start from (or stop at) the encoder output instead of a random h
+        :param train_data: concatenated views (cells * sum(view_dim))
+        :param train_h: h learned by train_ref_h (cells * lsd), the target of the encoder
+        '''
+        self.encoder = nn.Sequential(
+            nn.Linear(sum(self.view_dim), hidden_units),
+            nn.ReLU(),
+            nn.Linear(hidden_units, self.lsd),
+        ).to(device)
+        optimizer = optim.Adam(params=self.encoder.parameters(), lr=lr)
+        train_data = train_data.to(device)
+        train_h = train_h.detach().to(device)
+
+        self.encoder.train()
+        for epoch in range(epochs):
+            loss_sum = 0
+            perm = torch.randperm(train_data.shape[0], device=device)
+            for start in range(0, train_data.shape[0], batch_size):
+                batch = perm[start:start + batch_size]
+                loss = F.mse_loss(self.encoder(train_data[batch]), train_h[batch], reduction='sum')
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                loss_sum += loss.detach()
+            if epoch % 100 == 0:
+                print('epoch {:} encoder: mse {:.5f}'.format(epoch, float(loss_sum) / train_h.numel()))
+        self.encoder.eval()
+
+    def train_classifier_on_h(self,
+                              train_h,
+                              train_label,
+                              batch_size_classifier,
+                              epochs_classifier,
+                              patience_for_classifier,
+                              test_size,
+                              ):
+        '''
+            classifier training
+        '''
+        for param in self.net.parameters():
+            param.requires_grad = False
 
         train_h_numpy = train_h.detach().cpu().numpy()
         train_label_numpy = train_label.detach().cpu().numpy()
@@ -265,65 +455,100 @@ class CPMNets(torch.nn.Module):
         #     epochs_classifier = 100
         #     lr = 1e-3
 
-        self.classifier.train_classifier(train_h_numpy,
+        self.classifier_save = self.classifier.train_classifier(train_h_numpy,
                                          train_label_numpy,
-                                         patience_for_classifier,
-                                         save_path=self.save_path,
-                                         test_size=test_size,
-                                         batch_size=batch_size_classifier,
-                                         epochs=epochs_classifier,
-                                         lr=lr
-                                         )
+                                                                patience_for_classifier,
+                                                                save_path=self.save_path,
+                                                                test_size=test_size,
+                                                                batch_size=batch_size_classifier,
+                                                                epochs=epochs_classifier,
+                                                                lr=lr
+                                                                )
 
         self.ref_h = torch.from_numpy(train_h_numpy).float().to(device)
         self.ref_labels = train_label
-        # load already saved classifier
-        self.classifier = torch.load(os.path.join(self.save_path, 'classifier.pt'))
 
         return self.ref_h, self.ref_labels
 
-    def train_query_h(self, data, n_epochs, patience_for_cpm_query):
+    def train_query_h(self, data, n_epochs, patience_for_cpm_query, use_encoder=False, segments=None, seed=None):
         '''
         :param data: query data, not a list
         :param n_epochs: epochs for reconstruction
+        :param use_encoder: start from the encoder output instead of a random h (needs train_encoder),
+            with n_epochs = 0 the encoder output is returned as it is
+        :param segments: list of (start, stop) row ranges of data that are independent queries (e.g. the requests of
+            a server batch), each keeps its own early stopping and best h, so the result of a segment is the one of
+            train_query_h on its rows alone. None is one segment over all rows
+        :param seed: seed of the random h of every segment, None draws from the global generator
         :return:
         '''
         data = data.to(device)
+        if segments is None:
+            segments = [(0, data.shape[0])]
 
-        h_test = torch.zeros((data.shape[0], self.lsd), dtype=torch.float).to(device)
+        if use_encoder:
+            assert self.encoder is not None, 'encoder is not trained, set epochs_encoder in train_ref_h'
+            with torch.no_grad():
+                h_test = self.encoder(data).detach()
+        else:
+            h_test = torch.zeros((data.shape[0], self.lsd), dtype=torch.float).to(device)
+            for start, stop in segments:
+                # the xavier bound depends on the rows, initialize every segment as if it was alone
+                with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else [], enabled=seed is not None):
+                    if seed is not None:
+                        torch.manual_seed(seed)
+                    nn.init.xavier_uniform_(h_test[start:stop])
         h_test.requires_grad = True
-        nn.init.xavier_uniform_(h_test)
+        # the loss is a sum over rows and adam updates every element on its own, so the segments do not interact
         optimizer_for_query_h = optim.Adam(params=[h_test], lr=1e-2)
-        for i in range(self.view_num):
-            self.net[i] = self.net[i].to(device)
-            self.net[i].eval()
-        
-        min_r_loss = 999999999
-        min_r_loss_test_h = None
-        stop = 0
+        self.net = self.net.to(device)
+        self.net.eval()
+
+        n_seg = len(segments)
+        seg_id = torch.zeros(data.shape[0], dtype=torch.long, device=device)
+        for i, (start, stop) in enumerate(segments):
+            seg_id[start:stop] = i
+        min_r_loss = torch.full((n_seg,), float('inf'), device=device)
+        min_r_loss_test_h = h_test.detach().clone()
+        stop = torch.zeros(n_seg, dtype=torch.long, device=device)
+        active = torch.ones(n_seg, dtype=torch.bool, device=device)
+        # rows of the segments that did not stop yet, None while all of them run
+        rows = None
         for epoch in range(n_epochs):
-            r_loss = 0
-            for i in range(self.view_num):
-                r_loss += self.reconstrution_loss(self.net[i](h_test),
-                                                  data[:, self.view_idx[i]])
+            if rows is None:
+                row_loss = ((self.net(h_test) - data) ** 2).sum(dim=1)
+                r_loss = torch.zeros(n_seg, device=device).index_add_(0, seg_id, row_loss.detach())
+            else:
+                row_loss = ((self.net(h_test[rows]) - data[rows]) ** 2).sum(dim=1)
+                r_loss = torch.zeros(n_seg, device=device).index_add_(0, seg_id[rows], row_loss.detach())
+                frozen = h_test.detach()[done_rows].clone()
             optimizer_for_query_h.zero_grad()
-            r_loss.backward()
+            row_loss.sum().backward()
             optimizer_for_query_h.step()
+            if rows is not None:
+                with torch.no_grad():
+                    # adam momentum would keep moving the rows of stopped segments
+                    h_test[done_rows] = frozen
             if epoch % 100 == 0:
-                print('epoch {:} CPM query h: reconstruction loss {:}'.format(epoch, r_loss.detach().item()))
-
-            if r_loss < min_r_loss:
-                min_r_loss = r_loss
-                min_r_loss_test_h = h_test.detach().clone()
-                stop = 0
-                if epoch % 100 == 0:
-                    print('epoch {:} CPM query h: reconstruction loss {:}'.format(epoch, r_loss.detach().item()))
-
-            else:
-                stop += 1
-                if stop > patience_for_cpm_query:
-                    print("train query h stop at epoch {:}, min r loss {:.3f}".format(epoch, min_r_loss))
+                print('epoch {:} CPM query h: reconstruction loss {:}'.format(epoch, r_loss[active].sum().item()))
+
+            better = active & (r_loss < min_r_loss)
+            min_r_loss = torch.where(better, r_loss, min_r_loss)
+            better_rows = better[seg_id]
+            min_r_loss_test_h[better_rows] = h_test.detach()[better_rows]
+            stop = torch.where(better, torch.zeros_like(stop), stop + 1)
+            stopped = active & (stop > patience_for_cpm_query)
+            if stopped.any():
+                active &= ~stopped
+                if n_seg == 1:
+                    print("train query h stop at epoch {:}, min r loss {:.3f}".format(epoch, min_r_loss[0].item()))
+                else:
+                    print("train query h: {:} of {:} segments stopped at epoch {:}".format(
+                        n_seg - int(active.sum().item()), n_seg, epoch))
+                if not active.any():
                     break
+                done_rows = ~active[seg_id]
+                rows = torch.nonzero(~done_rows).reshape(-1)
         h_test = min_r_loss_test_h.detach().clone()
 
         return h_test
@@ -350,10 +575,18 @@ class scGNN(torch.nn.Module):
         # middle_out = int(max(5, G_data.num_features/64))
         # middle_out = int(max(8, G_data.num_features / 2))
         # middle_out = 128
-        self.conv1 = GCNConv(input_dim, middle_out)
-        self.conv2 = GCNConv(middle_out, input_dim)
+        # the graph comes normalized from construct_graph (cached with the MNN graph), not once per forward
+        self.conv1 = GCNConv(input_dim, middle_out, normalize=False)
+        self.conv2 = GCNConv(middle_out, input_dim, normalize=False)
         # self.conv3 = GCNConv(int(middle_out / 2), input_dim)
 
+    def __setstate__(self, state):
+        super(scGNN, self).__setstate__(state)
+        # models pickled when the convs still normalized the graph themselves
+        for conv in (self.conv1, self.conv2):
+            conv.normalize = False
+            conv.add_self_loops = False
+
     def forward(self, g_data):
         # x, edge_index = g_data.x.to(device), g_data.edge_index.to(device)
         x, adj = g_data[0].to(device), g_data[1].to(device)
@@ -377,6 +610,39 @@ class scGNN(torch.nn.Module):
 
         return x
 
+    def forward_batch(self, x, propagation, batch):
+        '''
+        same output as forward for the cells in batch, computed on their 2-hop neighborhood only
+        :param x: features (cells * genes), dense or sparse COO tensor, may stay on the host
+        :param propagation: csr_matrix D^-1/2 (A + I) D^-1/2 of the whole graph (what GCNConv normalizes to)
+        :param batch: sorted ndarray of cell indices
+        '''
+        p_batch = propagation[batch]
+        hop1 = np.unique(p_batch.indices)
+        p_hop1 = propagation[hop1]
+        hop2 = np.unique(p_hop1.indices)
+
+        x = x.index_select(0, torch.from_numpy(hop2.astype(np.int64))).to(device)
+        x = torch.sparse.mm(to_torch_sparse(p_hop1[:, hop2]).to(device), self.conv1.lin(x)) + self.conv1.bias
+        x = F.relu(x)
+        x = F.dropout(x, training=self.training)
+        x = torch.sparse.mm(to_torch_sparse(p_batch[:, hop1]).to(device), self.conv2.lin(x)) + self.conv2.bias
+        return x
+
+    def get_embedding_batched(self, x, propagation, batch_size):
+        '''
+        get_embedding computed batch by batch on the 1-hop neighborhoods
+        :return: ndarray (cells * middle_out)
+        '''
+        embeddings = []
+        for start in range(0, propagation.shape[0], batch_size):
+            p_batch = propagation[start:start + batch_size]
+            hop1 = np.unique(p_batch.indices)
+            x_hop1 = x.index_select(0, torch.from_numpy(hop1.astype(np.int64))).to(device)
+            embedding = torch.sparse.mm(to_torch_sparse(p_batch[:, hop1]).to(device), self.conv1.lin(x_hop1))
+            embeddings.append((embedding + self.conv1.bias).detach().cpu().numpy())
+        return np.concatenate(embeddings, axis=0)
+
 
 class MVCCModel(nn.Module):
 
@@ -401,10 +667,17 @@ class MVCCModel(nn.Module):
         self.model_path = os.path.join(save_path, 'model')
         self.label_encoder = label_encoder
         self.scaler = None
+        # ClassPrototypes of ref_h, used by predict_with_cpm
+        self.prototypes = None
 
-    def train_gcn(self, graph_data, model, data,
-                  mask_idx, i,
-                  epoch_gcn, patience_for_gcn, save_path):
+    def train_gcn(self, graph_data, model, masker, i,
+                  epoch_gcn, patience_for_gcn, save_path, mask_resample=False):
+        '''
+        :param graph_data: (feat, adj_t), feat already masked by masker
+        :param masker: DataMasker, its mask_idx / target are the reconstruction task
+        :param mask_resample: draw a new mask every epoch (written into feat in place)
+        '''
+        graph_data = (graph_data[0].to(device), graph_data[1].to(device))
 
         model.train()
         optimizer = torch.optim.Adam(model.parameters())
@@ -414,20 +687,18 @@ class MVCCModel(nn.Module):
         min_r_loss = 999999999
         best_model = None
         for epoch in range(epoch_gcn):
+            if mask_resample and epoch > 0:
+                masker.sample()
+                masker.apply(graph_data[0])
             pred = model(graph_data)
                         
-            dropout_pred = pred[mask_idx[0], mask_idx[1]]
-            dropout_true = data[mask_idx[0], mask_idx[1]]
+            dropout_pred = pred.view(-1)[masker.mask_idx]
 
             # mask columns
             # dropout_pred = pred[:, index_pair[1][masking_idx[1]]]
             # dropout_true = data[:, index_pair[1][masking_idx[1]]]
 
-            # loss = loss_fct(dropout_pred.view(-1),
-            #                 torch.tensor(dropout_true, dtype=torch.float).to(device).view(-1))
-
-            loss = loss_fct(dropout_pred,
-                            torch.tensor(dropout_true, dtype=torch.float).to(device))
+            loss = loss_fct(dropout_pred, masker.target)
 
             optimizer.zero_grad()
             loss.backward()
@@ -454,6 +725,129 @@ class MVCCModel(nn.Module):
         embedding = model.get_embedding(graph_data).detach().cpu().numpy()
         return z_score_scale(embedding)
 
+    def train_gcn_minibatch(self, feat, propagation, model, masker, i,
+                            epoch_gcn, patience_for_gcn, save_path, batch_size, mask_resample=False):
+        '''
+        train_gcn on mini-batches of cells: every batch only goes through its own 2-hop neighborhood,
+        so memory is bounded by the batch (and its neighbors) instead of the whole reference
+        :param feat: masked features (cells * genes) on the host, dense or sparse COO tensor
+        :param propagation: csr_matrix D^-1/2 (A + I) D^-1/2 of the view
+        '''
+        n_cells, n_genes = feat.shape
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters())
+        shuffle_rng = np.random.default_rng(i)
+
+        stop = 0
+        min_r_loss = 999999999
+        masked = _masked_entries_by_row(masker, n_cells, n_genes)
+        for epoch in range(epoch_gcn):
+            if mask_resample and epoch > 0:
+                masker.sample()
+                masker.apply(feat)
+                masked = _masked_entries_by_row(masker, n_cells, n_genes)
+            rows_ptr, cols, target = masked
+
+            loss_sum = 0
+            n_masked = 0
+            for batch in np.array_split(shuffle_rng.permutation(n_cells), max(1, n_cells // batch_size)):
+                batch = np.sort(batch)
+                starts, lengths = rows_ptr[batch], rows_ptr[batch + 1] - rows_ptr[batch]
+                if lengths.sum() == 0:
+                    continue
+                sel = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+                local_rows = torch.from_numpy(np.repeat(np.arange(batch.shape[0]), lengths)).to(device)
+
+                pred = model.forward_batch(feat, propagation, batch)
+                dropout_pred = pred[local_rows, torch.from_numpy(cols[sel]).to(device)]
+                loss = ((dropout_pred - torch.from_numpy(target[sel]).to(device)) ** 2).sum()
+
+                optimizer.zero_grad()
+                (loss / sel.shape[0]).backward()
+                optimizer.step()
+                loss_sum += loss.item()
+                n_masked += sel.shape[0]
+
+            # same value as the full-batch MSE over all masked entries
+            loss_item = loss_sum / max(n_masked, 1)
+            if loss_item < min_r_loss:
+                min_r_loss = loss_item
+                stop = 0
+                if epoch % 10 == 0:
+                    print('View {:} Epoch: {}, Training Loss {:.4f}'.format(i, epoch, loss_item))
+            else:
+                stop += 1
+                if stop > patience_for_gcn:
+                    print("View {:} stop at epoch {:}, min r loss {:.3f}".format(i, epoch, min_r_loss))
+                    break
+
+        # save the model
+        torch.save(model, os.path.join(save_path, 'gcn_model_' + str(i) + '.pt'))
+        model.eval()
+        with torch.no_grad():
+            embedding = model.get_embedding_batched(feat, propagation, batch_size)
+        return z_score_scale(embedding)
+
+    def train_view_gcn(self, i, data, sm_mat, masker, feat, k_neighbor, graph_cache,
+                       epoch_gcn, patience_for_gcn, mask_resample, batch_size_gcn):
+        '''
+        train the GCN of view i
+        :param feat: masked host features for mini-batch training, None for full-batch training
+        :return: z-scored embeddings of view i
+        '''
+        if batch_size_gcn is not None:
+            propagation = get_propagation(sm_mat, k_neighbor, graph_cache)
+            return self.train_gcn_minibatch(feat, propagation, self.gcn_models[i], masker, i,
+                                            epoch_gcn, patience_for_gcn, self.model_path,
+                                            batch_size_gcn, mask_resample=mask_resample)
+
+        graph_data = construct_graph(data, sm_mat, k_neighbor, graph_cache=graph_cache)
+        graph_data = (masker.apply(graph_data[0].to(device)), graph_data[1])
+        # unmasked_graph_data = construct_graph(data, sm_arr[i], k_neighbor)
+        return self.train_gcn(graph_data, self.gcn_models[i], masker, i,
+                              epoch_gcn, patience_for_gcn, self.model_path,
+                              mask_resample=mask_resample)
+
+    def train_gcn_views(self, data, sm_arr, masker, feat, k_neighbor, graph_cache,
+                        epoch_gcn, patience_for_gcn, mask_resample, batch_size_gcn, parallel_views=False):
+        '''
+        :param parallel_views: train all views at the same time, one thread per view
+            (torch releases the GIL in its kernels), every view keeps its own early stopping
+            and still saves gcn_model_i.pt. The order of random draws between views is not fixed,
+            so runs are not bit-for-bit reproducible in this mode
+        :return: list of z-scored embeddings, one per view
+        '''
+        if not parallel_views or self.view_num == 1:
+            ref_views = []
+            for i in range(self.view_num):
+                if mask_resample and i > 0:
+                    # the previous view re-sampled the mask, every view starts from the same first mask
+                    masker.reset()
+                    if feat is not None:
+                        masker.apply(feat)
+                ref_views.append(self.train_view_gcn(i, data, sm_arr[i], masker, feat, k_neighbor, graph_cache,
+                                                     epoch_gcn, patience_for_gcn, mask_resample, batch_size_gcn))
+            return ref_views
+
+        def train_view(i):
+            view_masker, view_feat = masker, feat
+            if mask_resample:
+                # every view re-samples its own mask, in its own features
+                view_masker = copy.deepcopy(masker)
+                if feat is not None:
+                    view_feat = feat.clone()
+            return self.train_view_gcn(i, data, sm_arr[i], view_masker, view_feat, k_neighbor, graph_cache,
+                                       epoch_gcn, patience_for_gcn, mask_resample, batch_size_gcn)
+
+        # share the intra-op threads between the views instead of oversubscribing the cores
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, num_threads // self.view_num))
+        try:
+            with ThreadPoolExecutor(max_workers=self.view_num) as pool:
+                return list(pool.map(train_view, range(self.view_num)))
+        finally:
+            torch.set_num_threads(num_threads)
+
     def fit(self,
             data,
             sm_arr,
@@ -472,13 +866,26 @@ class MVCCModel(nn.Module):
             test_size=0.2,
             patience_for_cpm_ref=200,
             patience_for_gcn=200,
+            mask_resample=False,
+            batch_size_gcn=None,
+            parallel_views=False,
+            class_loss_chunk_size=None,
+            batch_size_cpm=None,
+            epoch_encoder=0,
+            n_prototypes=1,
             classifier_hidden_units = 64,
             classifier_name="FC",
             gamma=1, # useless
+            graph_cache=None,
+            bundle=True,  # write the trained model as a bundle to model_path/bundle (MVCC.bundle)
             ):
 
         if not os.path.exists(self.model_path):
             os.makedirs(self.model_path)
+        labels = np.asarray(labels).reshape(-1)
+        if labels.min() < 0 or labels.max() >= self.class_num:
+            raise ValueError("labels must be encoded to [0, {:}) (class_num), got [{:}, {:}], "
+                             "see encode_label".format(self.class_num, labels.min(), labels.max()))
         
         if exp_mode == 1:
             # start from scratch
@@ -506,14 +913,9 @@ class MVCCModel(nn.Module):
                                      classifier_name=classifier_name,
                                      classifier_hidden_units=classifier_hidden_units
                                      ).to(device)
-            gcn_model_paths = ['gcn_model_0.pt',
-                               'gcn_model_1.pt',
-                               'gcn_model_2.pt',
-                               'gcn_model_3.pt',
-                               'gcn_model_4.pt']
-
             for i in range(self.view_num):
-                self.gcn_models.append(torch.load(os.path.join(self.model_path, gcn_model_paths[i])))
+                self.gcn_models.append(torch.load(os.path.join(self.model_path, 'gcn_model_' + str(i) + '.pt'),
+                                                  map_location=device, weights_only=False))
 
         
         ref_views = []
@@ -521,7 +923,17 @@ class MVCCModel(nn.Module):
         masked_prob = mask_rate
         print("gcn mask prob is {:.3f}".format(masked_prob))
 
-        masked_data, mask_idx = mask_data(data, masked_prob)
+        # the same mask is written into the features of every view
+        feat = None
+        if batch_size_gcn is None:
+            masker = DataMasker(data, masked_prob, seed=1, device=device)
+            masker.sample()
+        else:
+            # mini-batch training keeps the masked features on the host, only batches go to the device
+            masker = DataMasker(data, masked_prob, seed=1, device='cpu')
+            masker.sample()
+            feat = to_torch_sparse(data) if sp.issparse(data) else torch.tensor(data, dtype=torch.float)
+            masker.apply(feat)
 
         # masked_data, mask_idx = mask_cells(data, masked_prob)
 
@@ -530,25 +942,11 @@ class MVCCModel(nn.Module):
         # random.seed(seed)
         # masked_data, mask_idx = mask_column(data, masked_prob, random.sample(range(data.shape[1]), 300))
 
-        if exp_mode == 1:
-            # start from sratch
-            for i in range(self.view_num):
-                graph_data = construct_graph(masked_data, sm_arr[i], k_neighbor)
-                # unmasked_graph_data = construct_graph(data, sm_arr[i], k_neighbor)
-                embeddings = self.train_gcn(graph_data, self.gcn_models[i], data,
-                                            mask_idx, i,
-                                            epoch_gcn, patience_for_gcn, self.model_path)
-                # embeddings = z_score_scale(self.gcn_models[i].get_embedding(unmasked_graph_data).detach().cpu().numpy())
-                ref_views.append(embeddings)
-        elif exp_mode == 2:
-            # multi ref traing
-            for i in range(self.view_num):
-                graph_data = construct_graph(masked_data, sm_arr[i], k_neighbor)
-
-                embeddings = self.train_gcn(graph_data, self.gcn_models[i], data,
-                                            mask_idx, i,
-                                            epoch_gcn, patience_for_gcn, self.model_path)
-                ref_views.append(embeddings)
+        if exp_mode == 1 or exp_mode == 2:
+            # 1: start from sratch, 2: multi ref traing
+            ref_views = self.train_gcn_views(data, sm_arr, masker, feat, k_neighbor, graph_cache,
+                                             epoch_gcn, patience_for_gcn, mask_resample,
+                                             batch_size_gcn, parallel_views)
 
             # 尝试不train
             # for i in range(self.view_num):
@@ -558,7 +956,14 @@ class MVCCModel(nn.Module):
         elif exp_mode == 3:
             # GCN exist, only to test rest part of experiment (CPM net, classifier)
             for i in range(self.view_num):
-                graph_data = construct_graph(masked_data, sm_arr[i], k_neighbor)
+                if batch_size_gcn is not None:
+                    propagation = get_propagation(sm_arr[i], k_neighbor, graph_cache)
+                    with torch.no_grad():
+                        ref_views.append(z_score_scale(
+                            self.gcn_models[i].get_embedding_batched(feat, propagation, batch_size_gcn)))
+                    continue
+                graph_data = construct_graph(data, sm_arr[i], k_neighbor, graph_cache=graph_cache)
+                graph_data = (masker.apply(graph_data[0].to(device)), graph_data[1])
                 ref_views.append(z_score_scale(self.gcn_models[i].get_embedding(graph_data).detach().cpu().numpy()))
 
         ref_data = np.concatenate(ref_views, axis=1)
@@ -574,14 +979,31 @@ class MVCCModel(nn.Module):
                                                                  test_size=test_size,
                                                                  lamb=lamb,
                                                                  patience_for_cpm_ref=patience_for_cpm_ref,
-                                                                 exp_mode=exp_mode
+                                                                 exp_mode=exp_mode,
+                                                                 class_loss_chunk_size=class_loss_chunk_size,
+                                                                 batch_size_cpm=batch_size_cpm,
+                                                                 epochs_encoder=epoch_encoder
                                                                  )
+        self.build_prototypes(n_prototypes)
+        self.cpm_model.wait_saved()
+        if bundle:
+            # MVCC.bundle imports this module
+            from MVCC.bundle import save_bundle
+            save_bundle(self, os.path.join(self.model_path, 'bundle'))
         
 
-    def predict(self, data, sm_arr, epoch_cpm_query=500, k_neighbor=3, patience_for_cpm_query=100):        
+    def predict(self, data, sm_arr, epoch_cpm_query=500, k_neighbor=3, patience_for_cpm_query=100,
+                graph_cache=None, use_encoder=False):
+        '''
+        :param data: ndarray, scipy.sparse matrix or H5Matrix (read into memory, predict_chunked keeps memory bounded)
+        :param use_encoder: start query h from the encoder trained in fit (epoch_encoder > 0),
+            epoch_cpm_query = 0 then predicts in a single forward pass
+        '''
+        if isinstance(data, H5Matrix):
+            data = data.read()
         # trues = torch.from_numpy(trues).view(-1).float().to(device)
         
-        graphs = [construct_graph(data, sm_arr[i], k_neighbor)
+        graphs = [construct_graph(data, sm_arr[i], k_neighbor, graph_cache=graph_cache)
                   for i in range(self.view_num)]
         query_views = []
 
@@ -595,7 +1017,8 @@ class MVCCModel(nn.Module):
         query_data = np.concatenate(query_views, axis=1)
         query_data = torch.from_numpy(query_data).float().to(device)
 
-        self.query_h = self.cpm_model.train_query_h(query_data, epoch_cpm_query, patience_for_cpm_query)
+        self.query_h = self.cpm_model.train_query_h(query_data, epoch_cpm_query, patience_for_cpm_query,
+                                                    use_encoder=use_encoder)
 
         query_h_numpy = self.query_h.detach().cpu().numpy()
         self.scaler = self.cpm_model.scaler
@@ -606,12 +1029,122 @@ class MVCCModel(nn.Module):
 
         return pred.detach().cpu().numpy().reshape(-1)
 
-    def predict_with_cpm(self):
+    def _embed_block(self, data, propagations, block, genes=None, row_scale=None):
+        '''
+        GCN embeddings (get_embedding) of the cells in block for every view,
+        the expression of the 1-hop neighbors of block is read once for all views
+        :return: list of ndarray (len(block) * gcn_middle_out), one per view
+        '''
+        p_blocks = [propagation[block] for propagation in propagations]
+        hop1 = np.unique(np.concatenate([p_block.indices for p_block in p_blocks]))
+        x = _read_rows(data, hop1, genes, row_scale).to(device)
+        embeddings = []
+        with torch.no_grad():
+            for i in range(self.view_num):
+                conv = self.gcn_models[i].conv1
+                embedding = torch.sparse.mm(to_torch_sparse(p_blocks[i][:, hop1]).to(device), conv.lin(x)) + conv.bias
+                embeddings.append(embedding.cpu().numpy().astype(np.float64))
+        return embeddings
+
+    def predict_chunked(self, data, sm_arr, epoch_cpm_query=500, k_neighbor=3, patience_for_cpm_query=100,
+                        graph_cache=None, use_encoder=False, max_memory_mb=1024, block_size=None,
+                        genes=None, normalize=False):
+        '''
+        predict with bounded memory, the query is split into blocks of neighboring cells
+        (reverse Cuthill-McKee order of the union of the view graphs) that go one by one through
+        GCN embedding, query h and classification, the predictions keep the order of data.
+        GCN embeddings are the same as predict (global graph degrees, z-score over all cells in two passes),
+        query h is inferred per block, so the early stopping of train_query_h is decided per block
+        :param data: ndarray, scipy.sparse matrix or H5Matrix (cells * genes)
+        :param sm_arr: similarity matrices, ndarray, scipy.sparse (e.g. top k format) or h5py datasets,
+            the MNN graphs are built block by block from them
+        :param max_memory_mb: rough cap of the expression rows read for a block (the block and its neighbors)
+        :param block_size: cells per block, overrides max_memory_mb
+        :param genes: sorted gene indices to read, None reads all genes
+        :param normalize: apply mean_norm on the fly (row sums are computed block by block)
+        :return: predictions, ndarray (cells)
+        '''
+        n = data.shape[0]
+        propagations = [get_propagation(sm_arr[i], k_neighbor, graph_cache) for i in range(self.view_num)]
+
+        union = propagations[0].copy()
+        for propagation in propagations[1:]:
+            union = union + propagation
+        order = reverse_cuthill_mckee(union.tocsr(), symmetric_mode=True)
+
+        if block_size is None:
+            n_genes = data.shape[1] if genes is None else len(genes)
+            # a block reads its own rows and the rows of its neighbors
+            bytes_per_cell = 4 * n_genes * (1 + union.nnz / max(n, 1))
+            block_size = max(1, int(max_memory_mb * (1 << 20) / bytes_per_cell))
+        blocks = [np.sort(order[start:start + block_size]) for start in range(0, n, block_size)]
+        print("predict {:} cells in {:} blocks of {:} cells".format(n, len(blocks), block_size))
+
+        row_scale = None
+        if normalize:
+            if isinstance(data, H5Matrix):
+                row_sum = data.row_sums(cols=genes)
+            else:
+                row_sum = np.asarray((data if genes is None else data[:, genes]).sum(axis=1)).reshape(-1)
+            mean_transcript = np.mean(row_sum)
+            row_sum[np.where(row_sum == 0)] = 1
+            row_scale = mean_transcript / row_sum
+
+        for i in range(self.view_num):
+            self.gcn_models[i] = self.gcn_models[i].to(device)
+            self.gcn_models[i].eval()
 
-        pred_cpm = cpm_classify(self.ref_h.detach().cpu().numpy(), self.query_h.cpu().numpy(),
-                                self.ref_labels.detach().cpu().numpy())
+        # pass 1: mean and std of the embeddings over all cells
+        sums = [0 for i in range(self.view_num)]
+        square_sums = [0 for i in range(self.view_num)]
+        for block in blocks:
+            for i, embedding in enumerate(self._embed_block(data, propagations, block, genes, row_scale)):
+                sums[i] = sums[i] + embedding.sum(axis=0)
+                square_sums[i] = square_sums[i] + (embedding ** 2).sum(axis=0)
+        means = [s / n for s in sums]
+        stds = [np.sqrt(np.maximum(square_sums[i] / n - means[i] ** 2, 0)) for i in range(self.view_num)]
+
+        # pass 2: z-score, query h and classification block by block
+        self.scaler = self.cpm_model.scaler
+        pred = np.zeros(n, dtype=np.int64)
+        query_h = np.zeros((n, self.cpm_model.lsd), dtype=np.float32)
+        for block in blocks:
+            embeddings = self._embed_block(data, propagations, block, genes, row_scale)
+            query_data = np.concatenate([(embeddings[i] - means[i]) / stds[i] for i in range(self.view_num)], axis=1)
+            query_data = torch.from_numpy(query_data).float().to(device)
+            h = self.cpm_model.train_query_h(query_data, epoch_cpm_query, patience_for_cpm_query,
+                                             use_encoder=use_encoder)
+            h = self.scaler.transform(h.detach().cpu().numpy())
+            query_h[block] = h
+            pred[block] = self.cpm_model.classify(torch.from_numpy(h).float().to(device)).cpu().numpy().reshape(-1)
+
+        self.query_h = torch.from_numpy(query_h).to(device)
+        return pred
+
+    def build_prototypes(self, n_prototypes=1):
+        '''
+        :param n_prototypes: prototypes per class, 1 keeps the class means (same predictions as cpm_classify)
+        '''
+        self.prototypes = ClassPrototypes(self.ref_h, self.ref_labels, n_prototypes=n_prototypes, device=device)
+        return self.prototypes
 
-        return pred_cpm
+    def predict_with_cpm(self, return_scores=False, batch_size=65536, return_index=False):
+        '''
+        classify query_h by its similarity to the class prototypes of ref_h
+        :param return_scores: also return the score of every class (cells * classes)
+        :param return_index: return the index of the class among the sorted reference labels (as cpm_classify
+            and predict_with_cpm before the prototypes did) instead of the label itself
+        :return: predicted labels (encoded, like ref_labels), ndarray (cells)
+        '''
+        if getattr(self, 'prototypes', None) is None:
+            self.build_prototypes()
+        pred_cpm, scores = self.prototypes.predict(self.query_h.to(device), return_scores=True, batch_size=batch_size)
+        if return_index:
+            # prototypes.classes are sorted
+            pred_cpm = scores.argmax(dim=1)
+        if return_scores:
+            return pred_cpm.cpu().numpy(), scores.cpu().numpy()
+        return pred_cpm.cpu().numpy()
 
     def get_embeddings_with_data(self, data, sm_arr, epochs):
         
@@ -0,0 +1,68 @@
+"""
+    scatter plots of 2-d embeddings, rendered in worker processes
+    kept free of torch / umap so that the spawned workers start fast
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def plot_cluster(data, label, title, save_path):
+    '''
+    visualize clusters
+    :param data: 2-d data
+    :param label:
+    :param title: title for plot
+    :param save_path: the figure goes to save_path/image/<title>.png
+    '''
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+
+    save_path = os.path.join(save_path, 'image')
+    if not os.path.exists(save_path):
+        os.makedirs(save_path, exist_ok=True)
+
+    df = pd.DataFrame(data={
+        'x': data[:, 0],
+        'y': data[:, 1],
+        'label': label
+    })
+
+    plt.figure(figsize=(8, 6))
+    sns.scatterplot(data=df, x='x', y='y', hue='label', palette='deep', s=3)
+    plt.legend(loc=3, bbox_to_anchor=(1, 0))
+    plt.xlabel('UMAP1')
+    plt.ylabel('UMAP2')
+    plt.title(title)
+    plt.savefig(os.path.join(save_path, "_".join(title.split()) + '.png'), bbox_inches='tight')
+    plt.close()
+
+
+def _init_worker():
+    # workers only write files
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _plot_job(job):
+    plot_cluster(*job)
+
+
+def plot_clusters(jobs, workers=0):
+    '''
+    :param jobs: list of (data, label, title, save_path), the arguments of plot_cluster
+    :param workers: worker processes, 0 plots in this process, None means one per figure (at most the cores).
+        The workers are spawned, they import the __main__ module of the caller again:
+        a script has to keep its work under if __name__ == '__main__'
+    '''
+    if workers is None:
+        workers = min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1:
+        for job in jobs:
+            _plot_job(job)
+        return
+    # spawn, the parent usually holds torch / numba threads that do not survive a fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker) as pool:
+        list(pool.map(_plot_job, jobs))
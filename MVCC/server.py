@@ -0,0 +1,331 @@
+"""
+    resident predictor: load a trained MVCCModel once and serve predictions over HTTP
+
+    POST /predict   body: npz with
+                        data: expression (cells * genes, the same genes and normalization as for predict)
+                        sm_0 ... sm_{view_num - 1}: similarity matrices (cells * cells), or a csr_matrix
+                        given as sm_i_data, sm_i_indices, sm_i_indptr (e.g. the top k format)
+                    response: npz with pred (encoded labels) and label (decoded labels, if the model has a label encoder)
+    GET  /stats     JSON with queue depth, request / batch counts and latency percentiles (ms)
+
+    concurrent requests are queued and coalesced into micro-batches, the graphs of a micro-batch are put
+    on a block diagonal so that the requests never see each other's cells, GCN embeddings are z-scored per request,
+    query h is inferred per request from a fixed seed: a prediction does not depend on the rest of its micro-batch
+    requests are checked before they are queued, a bad request fails alone
+
+    usage:
+        python -m MVCC.server --model model/bundle --port 8765
+"""
+import io
+import os
+import json
+import time
+import queue
+import threading
+import argparse
+import urllib.request
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import scipy.sparse as sp
+import torch
+from MVCC.model import get_propagation, device
+from MVCC.classifiers import GCNClassifier
+from MVCC.bundle import load_bundle
+
+
+def _read_payload(payload, view_num):
+    '''
+    :return: data, list of similarity matrices
+    '''
+    with np.load(io.BytesIO(payload)) as f:
+        data = f['data']
+        sm_arr = []
+        for i in range(view_num):
+            if 'sm_{:}'.format(i) in f:
+                sm_arr.append(f['sm_{:}'.format(i)])
+            else:
+                sm_arr.append(sp.csr_matrix((f['sm_{:}_data'.format(i)],
+                                             f['sm_{:}_indices'.format(i)],
+                                             f['sm_{:}_indptr'.format(i)]), shape=(data.shape[0], data.shape[0])))
+    return data, sm_arr
+
+
+class Request(object):
+    def __init__(self, data, sm_arr):
+        self.data = data
+        self.sm_arr = sm_arr
+        self.start_time = time.time()
+        self.done = threading.Event()
+        self.pred = None
+        self.error = None
+
+
+class MVCCPredictor(object):
+    def __init__(self,
+                 model,
+                 k_neighbor=3,
+                 epoch_cpm_query=500,
+                 patience_for_cpm_query=100,
+                 use_encoder=False,
+                 max_batch_cells=20000,
+                 max_wait_ms=10,
+                 seed=0,
+                 ):
+        '''
+        :param model: trained MVCCModel
+        :param max_batch_cells: a micro-batch is closed once it holds this many cells
+        :param max_wait_ms: how long the first request of a micro-batch waits for others to join
+        :param seed: seed of the query h initialization, the same for every request
+        '''
+        self.model = model
+        self.k_neighbor = k_neighbor
+        self.epoch_cpm_query = epoch_cpm_query
+        self.patience_for_cpm_query = patience_for_cpm_query
+        self.use_encoder = use_encoder
+        self.max_batch_cells = max_batch_cells
+        self.max_wait_ms = max_wait_ms
+        self.seed = seed
+
+        for i in range(model.view_num):
+            model.gcn_models[i] = model.gcn_models[i].to(device)
+            model.gcn_models[i].eval()
+
+        self.queue = queue.Queue()
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.stats_lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def check_request(self, data, sm_arr):
+        '''
+        :raise ValueError: if data / sm_arr do not fit the model
+        '''
+        n_genes = self.model.gcn_models[0].conv1.in_channels
+        if len(data.shape) != 2 or data.shape[0] == 0:
+            raise ValueError("data must be a non-empty cells * genes matrix, got shape {:}".format(data.shape))
+        if data.shape[1] != n_genes:
+            raise ValueError("data has {:} genes, the model expects {:}".format(data.shape[1], n_genes))
+        if len(sm_arr) != self.model.view_num:
+            raise ValueError("{:} similarity matrices, the model has {:} views".format(len(sm_arr),
+                                                                                    self.model.view_num))
+        for i, sm in enumerate(sm_arr):
+            if tuple(sm.shape) != (data.shape[0], data.shape[0]):
+                raise ValueError("similarity matrix {:} has shape {:}, expected ({:}, {:})".format(
+                    i, sm.shape, data.shape[0], data.shape[0]))
+
+    def predict(self, data, sm_arr):
+        '''
+        blocking, called from the request threads
+        :return: predictions, ndarray (cells)
+        '''
+        self.check_request(data, sm_arr)
+        request = Request(data, sm_arr)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.pred
+
+    def _next_batch(self):
+        requests = [self.queue.get()]
+        n_cells = requests[0].data.shape[0]
+        deadline = time.time() + self.max_wait_ms / 1000
+        while n_cells < self.max_batch_cells:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            n_cells += request.data.shape[0]
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            try:
+                preds = self.predict_batch([r.data for r in requests], [r.sm_arr for r in requests])
+                for request, pred in zip(requests, preds):
+                    request.pred = pred
+            except Exception as e:
+                if len(requests) == 1:
+                    requests[0].error = e
+                else:
+                    # find the request that failed, the others still get their predictions
+                    for request in requests:
+                        try:
+                            request.pred = self.predict_batch([request.data], [request.sm_arr])[0]
+                        except Exception as request_error:
+                            request.error = request_error
+            end_time = time.time()
+            with self.stats_lock:
+                self.n_batches += 1
+                self.n_requests += len(requests)
+                self.batch_sizes.append(len(requests))
+                for request in requests:
+                    self.latencies.append(end_time - request.start_time)
+            for request in requests:
+                request.done.set()
+
+    def predict_batch(self, data_arr, sm_arrs):
+        '''
+        one pass of GCN embedding, query h and classification over several requests
+        :param data_arr: list of expression matrices, one per request
+        :param sm_arrs: list of similarity matrix lists, one per request
+        :return: list of predictions, one per request
+        '''
+        model = self.model
+        sizes = [data.shape[0] for data in data_arr]
+        bounds = np.cumsum([0] + sizes)
+        propagations = [sp.block_diag([get_propagation(sm_arr[i], self.k_neighbor) for sm_arr in sm_arrs],
+                                      format='csr')
+                        for i in range(model.view_num)]
+        if all(sp.issparse(data) for data in data_arr):
+            data = sp.vstack(data_arr, format='csr')
+        else:
+            data = np.concatenate([np.asarray(d.todense()) if sp.issparse(d) else d for d in data_arr], axis=0)
+
+        embeddings = model._embed_block(data, propagations, np.arange(bounds[-1]))
+        for embedding in embeddings:
+            # z-score per request, as predict does over its query
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                part = embedding[start:stop]
+                std = part.std(axis=0)
+                # constant columns (e.g. a one cell request) are centered only
+                std[std == 0] = 1
+                embedding[start:stop] = (part - part.mean(axis=0)) / std
+        query_data = torch.from_numpy(np.concatenate(embeddings, axis=1)).float().to(device)
+
+        # query h of all requests in one optimization, every request with its own early stopping and
+        # initialization from the same seed, so a request gets the same h in any batch
+        segments = list(zip(bounds[:-1], bounds[1:]))
+        h = model.cpm_model.train_query_h(query_data, self.epoch_cpm_query, self.patience_for_cpm_query,
+                                          use_encoder=self.use_encoder, segments=segments, seed=self.seed)
+        h = torch.from_numpy(model.cpm_model.scaler.transform(h.detach().cpu().numpy())).float().to(device)
+
+        if isinstance(model.cpm_model.classifier, GCNClassifier):
+            # the GCN classifier builds a kNN graph over its input, keep requests apart
+            return [model.cpm_model.classify(h[start:stop]).cpu().numpy().reshape(-1) for start, stop in segments]
+        pred = model.cpm_model.classify(h).cpu().numpy().reshape(-1)
+        return [pred[start:stop] for start, stop in segments]
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            result = {
+                'queue_depth': self.queue.qsize(),
+                'requests': self.n_requests,
+                'batches': self.n_batches,
+                'mean_batch_requests': float(batch_sizes.mean()) if batch_sizes.shape[0] > 0 else 0,
+            }
+        for q in [50, 90, 99]:
+            result['latency_p{:}_ms'.format(q)] = float(np.percentile(latencies, q)) if latencies.shape[0] > 0 else 0
+        return result
+
+
+def make_handler(predictor):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self._send(404, b'not found', 'text/plain')
+                return
+            self._send(200, json.dumps(predictor.stats()).encode(), 'application/json')
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send(404, b'not found', 'text/plain')
+                return
+            try:
+                payload = self.rfile.read(int(self.headers['Content-Length']))
+                data, sm_arr = _read_payload(payload, predictor.model.view_num)
+                pred = predictor.predict(data, sm_arr)
+            except Exception as e:
+                self._send(400, str(e).encode(), 'text/plain')
+                return
+            result = {'pred': pred}
+            if predictor.model.label_encoder is not None:
+                result['label'] = np.asarray(predictor.model.label_encoder.inverse_transform(pred)).astype(str)
+            body = io.BytesIO()
+            np.savez(body, **result)
+            self._send(200, body.getvalue(), 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(predictor, host='127.0.0.1', port=8765):
+    server = ThreadingHTTPServer((host, port), make_handler(predictor))
+    print("MVCC predictor listening on http://{:}:{:}".format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def predict_remote(url, data, sm_arr):
+    '''
+    client side of POST /predict
+    :param url: e.g. http://127.0.0.1:8765
+    :return: pred, label (None if the model has no label encoder)
+    '''
+    payload = {'data': data}
+    for i, sm in enumerate(sm_arr):
+        if sp.issparse(sm):
+            sm = sm.tocsr()
+            payload['sm_{:}_data'.format(i)] = sm.data
+            payload['sm_{:}_indices'.format(i)] = sm.indices
+            payload['sm_{:}_indptr'.format(i)] = sm.indptr
+        else:
+            payload['sm_{:}'.format(i)] = sm
+    body = io.BytesIO()
+    np.savez(body, **payload)
+    request = urllib.request.Request(url.rstrip('/') + '/predict', data=body.getvalue(), method='POST')
+    with urllib.request.urlopen(request) as response:
+        with np.load(io.BytesIO(response.read())) as f:
+            return f['pred'], (f['label'] if 'label' in f else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='[MVCC] predictor service')
+    parser.add_argument('--model', type=str, required=True,
+                        help='bundle directory (MVCC.bundle.save_bundle) or MVCCModel saved with torch.save')
+    parser.add_argument('--host', default='127.0.0.1', type=str, required=False)
+    parser.add_argument('--port', default=8765, type=int, required=False)
+    parser.add_argument('--k_neighbor', default=3, type=int, required=False)
+    parser.add_argument('--epoch_cpm_query', default=500, type=int, required=False)
+    parser.add_argument('--use_encoder', action='store_true', help='start query h from the CPM encoder')
+    parser.add_argument('--max_batch_cells', default=20000, type=int, required=False)
+    parser.add_argument('--max_wait_ms', default=10, type=float, required=False)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.model):
+        model = load_bundle(args.model)
+    else:
+        model = torch.load(args.model, map_location=device, weights_only=False)
+    predictor = MVCCPredictor(model,
+                              k_neighbor=args.k_neighbor,
+                              epoch_cpm_query=args.epoch_cpm_query,
+                              use_encoder=args.use_encoder,
+                              max_batch_cells=args.max_batch_cells,
+                              max_wait_ms=args.max_wait_ms)
+    serve(predictor, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
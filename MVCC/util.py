@@ -1,22 +1,23 @@
 import math
+import hashlib
 import os.path
 import random
 import numpy as np
 import copy
 import sklearn
-from sklearn.neighbors import kneighbors_graph
 from torch_sparse import SparseTensor
 import torch
 from torch_geometric.data import Data as geoData
-import networkx as nx
-from sklearn.preprocessing import OneHotEncoder
-import matplotlib.pyplot as plt
 import pandas as pd
-import umap
 from sklearn.metrics import silhouette_score, adjusted_rand_score, accuracy_score, f1_score
-import seaborn as sns
-import wandb
 import scipy.spatial as spt
+import scipy.sparse as sp
+import h5py
+from MVCC.knn import KNNIndex
+from MVCC.metrics import encode_labels, confusion_matrix, class_metrics, neighborhood_counts, row_normalize, \
+    plot_matrix
+from MVCC.plotting import plot_cluster, plot_clusters
+from concurrent.futures import ThreadPoolExecutor
 from random import sample
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import LabelEncoder
@@ -34,15 +35,20 @@ def setup_seed(seed):
 
 def mean_norm(data):
     '''    
-    :param data: ndarray (cells * genes)
-    :return: 返回归一化的矩阵
+    :param data: ndarray, scipy.sparse matrix or H5Matrix (cells * genes)
+    :return: 返回归一化的矩阵, csr_matrix if data is sparse, a H5Matrix that normalizes on read if data is a H5Matrix
     '''
-    row_sum = np.sum(data, axis=1)
+    row_sum = data.row_sums() if isinstance(data, H5Matrix) else np.asarray(data.sum(axis=1)).reshape(-1)
     mean_transcript = np.mean(row_sum)        
     row_sum[np.where(row_sum == 0)] = 1
 
+    if isinstance(data, H5Matrix):
+        return data.scaled(mean_transcript / row_sum)
+
     scale_factor = 1e4
     # data_norm = np.log1p((data / row_sum.reshape(-1 ,1))*scale_factor)
+    if sp.issparse(data):
+        return (sp.diags(mean_transcript / row_sum) @ data).tocsr()
     data_norm = (data / row_sum.reshape(-1, 1)) * mean_transcript
 
     return data_norm
@@ -57,23 +63,35 @@ def z_score_scale(data):
 
 def mask_data(data, masked_prob):
     '''
-    :param data: expression data (cells * genes)
+    :param data: expression data (cells * genes), ndarray or scipy.sparse matrix
     :param masked_prob: mask probability
     :return:
-        1. X: masked data
+        1. X: masked data (csr_matrix if data is sparse)
         2. index_pair: [(row),(col)],
         3. masking_idx: index of masked data
         X[index_pair[0][masking_idx], index_pair[1][masking_idx]] is the masked data
     '''
-    index_pair = np.where(data != 0)
+    if sp.issparse(data):
+        # stored entries of a sorted csr matrix are in the same (row-major) order as np.where(data != 0)
+        X = data.tocsr(copy=True)
+        X.eliminate_zeros()
+        X.sort_indices()
+        index_pair = (np.repeat(np.arange(X.shape[0]), np.diff(X.indptr)), X.indices)
+    else:
+        index_pair = np.where(data != 0)
     seed = 1
     np.random.seed(seed)
     idx = np.random.choice(index_pair[0].shape[0], int(index_pair[0].shape[0] * masked_prob), replace=False)
 
     # masking_idx = [idx, idx]
     # to retrieve the position of the masked: data_train[index_pair_train[0][masking_idx], index_pair[1][masking_idx]]
-    X = copy.deepcopy(data)
     mask_idx = [index_pair[0][idx], index_pair[1][idx]]
+    if sp.issparse(data):
+        X.data[idx] = 0
+        X.eliminate_zeros()
+        return X, mask_idx
+
+    X = copy.deepcopy(data)
     X[mask_idx[0], mask_idx[1]] = 0
 
     return X, mask_idx
@@ -83,22 +101,89 @@ def mask_cells(data, masked_prob):
     
     seed = 1
     random.seed(seed)
-    mask_rows = []
-    mask_cols = []
     num = int(data.shape[1] * masked_prob)
     mask_col_idx = random.sample(range(data.shape[1]), num)
-    for i in range(data.shape[0]):
-        mask_rows += [i] * num
-        mask_cols += mask_col_idx
-        # mask_col_idx = random.sample(range(data.shape[1]), num)
-        # mask_cols += mask_col_idx
-    X = copy.deepcopy(data)
-    # print(index_pair[0])
+    # the same columns are masked in every cell
+    mask_rows = np.repeat(np.arange(data.shape[0]), num)
+    mask_cols = np.tile(np.array(mask_col_idx, dtype=np.int64), data.shape[0])
+    X = data.copy()
     X[mask_rows, mask_cols] = 0
     mask_idx = [mask_rows, mask_cols]
     return X, mask_idx
 
 
+class DataMasker(object):
+    '''
+    masks nonzero entries of the expression data for the GCN reconstruction task
+    the nonzero positions are found once, masks are drawn on the target device with a seeded torch.Generator,
+    flat masked indices and reconstruction targets live on the target device and are rewritten in place,
+    so sampling a new mask every epoch needs no host work and no transfer
+    usage:
+        masker = DataMasker(data, 0.3, device=device)
+        masker.sample()
+        feat = masker.apply(feat)   # feat: cells * genes tensor, dense or sparse COO built from data
+        loss = loss_fct(pred.view(-1)[masker.mask_idx], masker.target)
+    '''
+
+    def __init__(self, data, masked_prob, seed=1, device='cpu'):
+        if sp.issparse(data):
+            data = data.tocsr(copy=True)
+            data.eliminate_zeros()
+            data.sort_indices()
+            rows = np.repeat(np.arange(data.shape[0], dtype=np.int64), np.diff(data.indptr))
+            flat_nonzero = rows * data.shape[1] + data.indices
+            values = data.data
+        else:
+            flat_nonzero = np.flatnonzero(data)
+            values = data.reshape(-1)[flat_nonzero]
+
+        self.shape = data.shape
+        self.seed = seed
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+        self.n_nonzero = flat_nonzero.shape[0]
+        self.n_mask = int(flat_nonzero.shape[0] * masked_prob)
+        # permutation of the nonzeros, refilled in place by every sample
+        self.perm = torch.empty(self.n_nonzero, dtype=torch.long, device=device)
+
+        # position of the masked entries among the nonzeros (the order of a coalesced sparse tensor's values)
+        self.nonzero_idx = torch.zeros(self.n_mask, dtype=torch.long, device=device)
+        self.flat_nonzero = torch.from_numpy(flat_nonzero.astype(np.int64)).to(device)
+        self.values = torch.from_numpy(values.astype(np.float32)).to(device)
+        # X.view(-1)[mask_idx] are the masked entries, target is their true value
+        self.mask_idx = torch.zeros(self.n_mask, dtype=torch.long, device=device)
+        self.target = torch.zeros(self.n_mask, dtype=torch.float, device=device)
+
+    def sample(self):
+        torch.randperm(self.n_nonzero, generator=self.generator, out=self.perm)
+        self.nonzero_idx.copy_(self.perm[:self.n_mask])
+        torch.index_select(self.flat_nonzero, 0, self.nonzero_idx, out=self.mask_idx)
+        torch.index_select(self.values, 0, self.nonzero_idx, out=self.target)
+        return self.mask_idx, self.target
+
+    def reset(self):
+        '''
+        back to the first mask drawn after construction (reseed and sample)
+        '''
+        self.generator.manual_seed(self.seed)
+        return self.sample()
+
+    def apply(self, feat):
+        '''
+        write the current mask into feat in place, entries masked by an earlier sample are restored first
+        :param feat: tensor (cells * genes) built from the unmasked data, dense or coalesced sparse COO
+        '''
+        if feat.is_sparse:
+            values = feat._values()
+            values.copy_(self.values)
+            values.index_fill_(0, self.nonzero_idx, 0)
+        else:
+            flat = feat.view(-1)
+            flat.index_copy_(0, self.flat_nonzero, self.values)
+            flat.index_fill_(0, self.mask_idx, 0)
+        return feat
+
+
 def mask_column(data, masked_prob, cols):
     tmp_data = data[:, cols]
     index_pair = np.where(tmp_data != 0)
@@ -118,60 +203,79 @@ def mask_column(data, masked_prob, cols):
     return X, mask_idx
 
 
-def construct_graph_with_knn(data, k=2):
-    A = kneighbors_graph(data, k, mode='connectivity', include_self=False)  
-    G = nx.from_numpy_matrix(A.todense())
-    edges = []
-    
-    for (u, v) in G.edges():
-        edges.append([u, v])
-        edges.append([v, u])
-    edges = np.array(edges).T
-    edges = torch.tensor(edges, dtype=torch.long)
+def stratified_batches(labels, batch_size, rng):
+    '''
+    split the cells into batches that keep the class proportions of labels
+    :param labels: ndarray (cells)
+    :param rng: np.random.Generator
+    :return: list of ndarray of cell indices
+    '''
+    n_batch = max(1, int(math.ceil(labels.shape[0] / batch_size)))
+    # group the cells by class in random order, then deal them out to the batches in turn
+    order = np.lexsort((rng.random(labels.shape[0]), labels))
+    return [np.sort(order[i::n_batch]) for i in range(n_batch)]
+
+
+def construct_graph_with_knn(data, k=2, method='exact', n_jobs=None):
+    '''
+    :param method: kNN backend of MVCC.knn.KNNIndex, 'exact', 'nndescent' or 'hnsw'
+    :return: geoData, edges of the symmetrised kNN graph in both directions
+    '''
+    A = KNNIndex(method, n_jobs=n_jobs).build(data, k).kneighbors_graph(k)
+    A = A.maximum(A.T).tocoo()
+    edges = torch.tensor(np.vstack([A.row, A.col]), dtype=torch.long)
     feat = torch.tensor(data, dtype=torch.float)
     
     g_data = geoData(x=feat, edge_index=edges)
     return g_data
 
 
+def knn_edge_index(x, k=2, block_size=4096):
+    '''
+    same graph as construct_graph_with_knn, computed on the device of x
+    :param x: tensor (cells * features)
+    :param k: number of neighbors (euclidean, a cell is not its own neighbor)
+    :return: edge_index (2 * edges) of the symmetrised kNN graph, every edge in both directions once
+    '''
+    n = x.shape[0]
+    k = min(k, n - 1)
+    if k <= 0:
+        return torch.zeros((2, 0), dtype=torch.long, device=x.device)
+    rows = []
+    cols = []
+    # only a block of the distance matrix exists at a time
+    for start in range(0, n, block_size):
+        dist = torch.cdist(x[start:start + block_size], x)
+        diag = torch.arange(dist.shape[0], device=x.device)
+        dist[diag, diag + start] = float('inf')
+        cols.append(torch.topk(dist, k, dim=1, largest=False)[1].reshape(-1))
+        rows.append((diag + start).repeat_interleave(k))
+    rows, cols = torch.cat(rows), torch.cat(cols)
+    edges = torch.unique(torch.cat([rows * n + cols, cols * n + rows]))
+    return torch.stack([edges // n, edges % n])
+
+
 def check_out_similarity_matrix(sm, labels, k, sm_name):
-    
-    sm = construct_adjacent_matrix_with_MNN(sm, k)
-    types = sorted(list(set(labels)))
-    
-    confusion_matrix = []
-    for i in range(len(set(types))):
-        confusion_matrix.append([0 for j in range(len(types))])
-
-    for i, label in enumerate(types):
-        idx = np.where(labels == label)
-        label_sm = sm[idx[0], :]
-        sm_sum = label_sm.sum(axis=0)
-        # print("For {:}({:}), his neighbor situation is".format(label, len(idx[0])))
-        for j, type_x in enumerate(types):
-            type_x_idx = np.where(labels == type_x)
-            # print("{:}: {:} egdes".format(type_x, sum(sm_sum[type_x_idx])))
-            confusion_matrix[i][j] = sum(sm_sum[type_x_idx])
-    
-    confusion_mat = np.array(confusion_matrix)    
-    confusion_mat = confusion_mat / np.sum(confusion_mat, axis=1).reshape(-1, 1)
-    data_df = pd.DataFrame(
-        confusion_mat
-    )
-    data_df.columns = types
-    data_df.index = types
+    '''
+    heatmap of the share of MNN edges between every pair of cell types
+    '''
+    sm = construct_sparse_adjacent_matrix_with_MNN(sm, k)
+    types, codes = encode_labels(labels)
 
-    sns.heatmap(data=data_df, cmap="Blues", cbar=True, xticklabels=True, yticklabels=True)
-    plt.savefig(sm_name, dpi=300, bbox_inches="tight")
-    plt.clf()
+    confusion_mat = row_normalize(neighborhood_counts(sm, codes, types.shape[0]))
+    plot_matrix(confusion_mat, types, types, sm_name, cbar=True, dpi=300)
 
 
 
 
 
-def get_similarity_matrix(data, k=2):    
-    A = kneighbors_graph(data, k, mode='connectivity', include_self=False)  # 拿到Similarity矩阵
-    return A.todense()
+def get_similarity_matrix(data, k=2, method='exact', n_jobs=None, sparse=False):
+    '''
+    :param method: kNN backend of MVCC.knn.KNNIndex, 'exact', 'nndescent' or 'hnsw'
+    :param sparse: return the csr_matrix instead of a dense matrix
+    '''
+    A = KNNIndex(method, n_jobs=n_jobs).build(data, k).kneighbors_graph(k)  # 拿到Similarity矩阵
+    return A if sparse else A.todense()
 
 def construct_adjacent_matrix(similarity_mat, k):    
     if k==0:
@@ -198,57 +302,369 @@ def construct_adjacent_matrix(similarity_mat, k):
     adjacent_mat = similarity_mat.astype(np.int64)
     return adjacent_mat
 
-def construct_adjacent_matrix_with_MNN(similarity_mat, k):        
-    k_idxs = []    
-    similarity_mat[np.diag_indices_from(similarity_mat)] = 0
-    for i in range(similarity_mat.shape[0]):
-        top_k_idx = similarity_mat[i].argsort()[::-1][0:k]
-        k_idxs.append(top_k_idx)
-    adjacent_mat = np.zeros(shape=similarity_mat.shape)
-    for i in range(similarity_mat.shape[0]):
-        adjacent_mat[i, k_idxs[i]] = 1
-
+def _candidate_block(similarity_mat, start, stop, row_offset=0):
+    '''
+    :return: cols, weight of rows [start, stop), cols is None for a dense matrix (all columns),
+        for a sparse matrix only the stored entries are candidates, padded with col -1 / weight -inf
+    '''
+    rows = np.arange(stop - start)
+    diag = rows + start + row_offset
+    if sp.issparse(similarity_mat):
+        block = similarity_mat[start:stop]
+        counts = np.diff(block.indptr)
+        width = max(int(counts.max()) if counts.shape[0] > 0 else 0, 1)
+        cols = np.full((stop - start, width), -1, dtype=np.int64)
+        weight = np.full((stop - start, width), -np.inf)
+        entry_rows = np.repeat(rows, counts)
+        entry_pos = np.arange(block.indices.shape[0]) - block.indptr[entry_rows]
+        cols[entry_rows, entry_pos] = block.indices
+        weight[entry_rows, entry_pos] = block.data
+        weight[cols == diag.reshape(-1, 1)] = -np.inf
+        return cols, weight
+
+    weight = np.array(similarity_mat[start:stop], dtype=np.float64)
+    in_block = diag < weight.shape[1]
+    weight[rows[in_block], diag[in_block]] = -np.inf
+    return None, weight
+
+
+def top_k_neighbors(similarity_mat, k, block_size=2048, n_jobs=None, row_offset=0):
+    '''
+    pick the k largest weights of every row with partial selection, block by block
+    (the diagonal is skipped, so a cell is never its own neighbor)
+    :param similarity_mat: ndarray, scipy.sparse matrix or h5py dataset (cells * cells),
+        a sparse matrix only offers its stored entries as neighbors
+    :param k: number of neighbors
+    :param block_size: rows handled by one block, only this block is ever copied
+    :param n_jobs: number of worker threads, None means all cores
+    :param row_offset: index of the first row, when similarity_mat is a row chunk of a larger matrix
+    :return: k_idx, k_weight: ndarray (cells * k), sorted by weight in descending order,
+        rows with less than k candidates are padded with index -1
+    '''
+    n = similarity_mat.shape[0]
+    k = max(min(k, similarity_mat.shape[1] - 1), 0)
+    if sp.issparse(similarity_mat):
+        similarity_mat = similarity_mat.tocsr()
+
+    def select(start):
+        stop = min(start + block_size, n)
+        cols, block = _candidate_block(similarity_mat, start, stop, row_offset=row_offset)
+        k_block = min(k, block.shape[1])
+        idx = np.argpartition(-block, k_block - 1, axis=1)[:, :k_block] if k_block > 0 \
+            else np.zeros((stop - start, 0), dtype=np.int64)
+        weight = np.take_along_axis(block, idx, axis=1)
+        order = np.argsort(-weight, axis=1, kind='stable')
+        idx, weight = np.take_along_axis(idx, order, axis=1), np.take_along_axis(weight, order, axis=1)
+        if cols is not None:
+            idx = np.take_along_axis(cols, idx, axis=1)
+            idx[np.isneginf(weight)] = -1
+        if k_block < k:
+            idx = np.pad(idx, ((0, 0), (0, k - k_block)), constant_values=-1)
+            weight = np.pad(weight, ((0, 0), (0, k - k_block)), constant_values=-np.inf)
+        return idx, weight
+
+    # numpy releases the GIL in argpartition/argsort, threads are enough here
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        blocks = list(pool.map(select, range(0, n, block_size)))
+    if len(blocks) == 0:
+        return np.zeros((0, k), dtype=np.int64), np.zeros((0, k))
+    k_idx = np.concatenate([b[0] for b in blocks], axis=0)
+    k_weight = np.concatenate([b[1] for b in blocks], axis=0)
+    return k_idx, k_weight
+
+
+def construct_sparse_adjacent_matrix_with_MNN(similarity_mat, k, block_size=2048, n_jobs=None):
+    '''
+    mutual nearest neighbors graph without any dense cells * cells intermediate
+    :param similarity_mat: ndarray or scipy.sparse matrix (cells * cells)
+    :param k: number of neighbors
+    :return: scipy.sparse.csr_matrix (cells * cells), 1 if two cells are in each other's top k
+    '''
+    n = similarity_mat.shape[0]
+    k_idx, _ = top_k_neighbors(similarity_mat, k, block_size=block_size, n_jobs=n_jobs)
+    rows = np.repeat(np.arange(n), k_idx.shape[1])
+    cols = k_idx.reshape(-1)
+    rows, cols = rows[cols >= 0], cols[cols >= 0]
+    adjacent_mat = sp.csr_matrix((np.ones(rows.shape[0], dtype=np.int64), (rows, cols)),
+                                 shape=(n, n))
     # should contain each other
-    adjacent_mat = np.logical_and(adjacent_mat, adjacent_mat.T)
-    adjacent_mat = adjacent_mat.astype(np.int64)
-    
+    adjacent_mat = adjacent_mat.multiply(adjacent_mat.T).tocsr()
+    adjacent_mat.eliminate_zeros()
     return adjacent_mat
 
-def construct_graph(data, sm_mat, k):
 
-    sm_mat = construct_adjacent_matrix_with_MNN(sm_mat, k)
-    # sm_mat = construct_adjacent_matrix(sm_mat, k)
+def construct_adjacent_matrix_with_MNN(similarity_mat, k):
+    adjacent_mat = construct_sparse_adjacent_matrix_with_MNN(similarity_mat, k)
+    return adjacent_mat.toarray()
 
-    graph = nx.from_numpy_matrix(np.matrix(sm_mat))
+def adjacent_mat_to_sparse_tensor(adjacent_mat, weighted=False):
+    '''
+    :param adjacent_mat: scipy.sparse matrix (cells * cells)
+    :param weighted: keep the values of adjacent_mat as edge weights
+    :return: SparseTensor with the same edges and weight 1
+    '''
+    adjacent_mat = adjacent_mat.tocoo()
+    row = torch.from_numpy(adjacent_mat.row.astype(np.int64))
+    col = torch.from_numpy(adjacent_mat.col.astype(np.int64))
+    if weighted:
+        value = torch.from_numpy(adjacent_mat.data.astype(np.float32))
+    else:
+        value = torch.ones(row.shape[0], dtype=torch.float)
+    return SparseTensor(row=row, col=col, value=value, sparse_sizes=adjacent_mat.shape)
 
-    edges = []
-    
-    for (u, v) in graph.edges():
-        edges.append([u, v])
-        edges.append([v, u])
 
-    edges = np.array(edges).T
+def gcn_propagation(adjacent_mat, deg_self_loop=None):
+    '''
+    :param adjacent_mat: scipy.sparse matrix A (cells * cells)
+    :param deg_self_loop: degree of A + I, computed if not given
+    :return: csr_matrix float32 D^-1/2 (A + I) D^-1/2, what GCNConv normalizes A to
+    '''
+    if deg_self_loop is None:
+        deg_self_loop = np.asarray(adjacent_mat.sum(axis=1)).reshape(-1).astype(np.float32) + 1
+    deg_inv_sqrt = sp.diags(np.power(deg_self_loop, -0.5))
+    propagation = deg_inv_sqrt @ (adjacent_mat + sp.identity(adjacent_mat.shape[0], format='csr')) @ deg_inv_sqrt
+    return propagation.tocsr().astype(np.float32)
 
-    edges = torch.tensor(edges, dtype=torch.long)
 
-    sm_mat = torch.tensor(sm_mat, dtype=torch.float)
-    adj = SparseTensor.from_dense(sm_mat)
-    feat = torch.tensor(data, dtype=torch.float)
+def to_torch_sparse(data):
+    '''
+    :param data: scipy.sparse matrix
+    :return: torch sparse COO float tensor
+    '''
+    data = data.tocoo()
+    nonzero = data.data != 0
+    index = torch.from_numpy(np.vstack([data.row[nonzero], data.col[nonzero]]).astype(np.int64))
+    values = torch.from_numpy(data.data[nonzero].astype(np.float32))
+    return torch.sparse_coo_tensor(index, values, size=data.shape).coalesce()
 
-    
-    g_data = geoData(x=feat, edge_index=edges)
 
+def construct_graph(data, sm_mat, k, graph_cache=None):
+    '''
+    :param data: expression data (cells * genes), input features of GCN, a scipy.sparse matrix
+        becomes a sparse feature tensor
+    :param sm_mat: similarity matrix (cells * cells)
+    :param k: number of neighbors
+    :param graph_cache: MVCC.graph_cache.GraphCache, reuse the MNN graph of (sm_mat, k) if given
+    :return: (feat, adj_t), adj_t is a transposed SparseTensor of the normalized MNN graph D^-1/2 (A + I) D^-1/2,
+        scGNN does not normalize it again
+    '''
+    if graph_cache is not None:
+        propagation = graph_cache.get(sm_mat, k, propagation=True)['propagation']
+    else:
+        propagation = gcn_propagation(construct_sparse_adjacent_matrix_with_MNN(sm_mat, k))
+    adj = adjacent_mat_to_sparse_tensor(propagation, weighted=True)
+    feat = to_torch_sparse(data) if sp.issparse(data) else torch.tensor(data, dtype=torch.float)
 
-    # return g_data
     return (feat, adj.t())
 
 
-def read_data_label_h5(path, key):
+def _h5_format(f, key):
+    mat_format = f[key].attrs.get('mvcc_format', '') if key in f else ''
+    return mat_format.decode() if isinstance(mat_format, bytes) else mat_format
+
+
+def _h5_values(f, key):
+    '''
+    :return: h5py dataset holding the values of a matrix written by the streaming conversion (format 'dense')
+        or of a single block numeric pandas DataFrame, None otherwise
+    '''
+    if _h5_format(f, key) == 'dense':
+        return f[key]['values']
+    if key in f and f[key].attrs.get('nblocks', 0) == 1 and 'block0_values' in f[key] \
+            and f[key]['block0_values'].dtype.kind in 'fiu':
+        return f[key]['block0_values']
+    return None
+
+
+def read_matrix_h5(data_path, key, sparse=False, block_size=4096):
+    '''
+    :param sparse: return a float32 csr_matrix, built row block by row block
+    :return: matrix of a streaming conversion (format 'dense') or of a single block pandas DataFrame,
+        None if the DataFrame has to be read by pandas
+    '''
+    with h5py.File(data_path, 'r') as f:
+        values = _h5_values(f, key)
+        if values is None or (not sparse and _h5_format(f, key) != 'dense'):
+            return None
+        if not sparse:
+            return values[:]
+        return sp.vstack([sp.csr_matrix(values[start:start + block_size], dtype=np.float32)
+                          for start in range(0, values.shape[0], block_size)], format='csr')
+
+
+class H5Matrix(object):
+    '''
+    lazy handle on a cells * genes matrix of data.h5, nothing is read until rows / genes are asked for,
+    and only those rows / genes are read (no DataFrame in between)
+    usage:
+        with H5Matrix(path, 'ref_1/data') as data:
+            block = data[0:1000]
+            sub = data.read(cols=gene_idx)
+    '''
+
+    def __init__(self, path, key, block_size=4096):
+        self.data_path = os.path.join(path, 'data.h5')
+        self.key = key
+        self.block_size = block_size
+        self.file = h5py.File(self.data_path, 'r')
+        self.values = _h5_values(self.file, key)
+        if self.values is None:
+            self.file.close()
+            raise ValueError("{:} is not a numeric matrix that can be read lazily, "
+                             "convert it with data_csv2h5.py --chunksize".format(key))
+        self.shape = self.values.shape
+        self.dtype = self.values.dtype
+        # factor of every cell applied on read (see scaled), None reads the stored values
+        self.row_scale = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        file = getattr(self, 'file', None)
+        if file is not None and file.id.valid:
+            file.close()
+
+    def scaled(self, row_scale):
+        '''
+        :param row_scale: factor of every cell (cells,)
+        :return: H5Matrix on the same file whose reads are multiplied row-wise by row_scale (closing one closes both)
+        '''
+        view = copy.copy(self)
+        view.row_scale = row_scale if self.row_scale is None else self.row_scale * row_scale
+        return view
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            return self.read(item[0], item[1])
+        return self.read(item)
+
+    def read(self, rows=None, cols=None, sparse=False):
+        '''
+        :param rows: slice or index array of cells, None reads all cells (block by block)
+        :param cols: sorted index array of genes, None reads all genes
+        :param sparse: return a float32 csr_matrix
+        '''
+        if rows is None:
+            blocks = [block for _, block in self.iter_blocks(cols=cols, sparse=sparse)]
+            if sparse:
+                return sp.vstack(blocks, format='csr')
+            return np.concatenate(blocks, axis=0)
+
+        if isinstance(rows, slice):
+            block = self._read_cols(rows, cols)
+            scale = None if self.row_scale is None else self.row_scale[rows]
+        else:
+            # h5py only takes one increasing index list per read, so rows are read sorted and then put back
+            rows = np.asarray(rows)
+            uniq, inverse = np.unique(rows, return_inverse=True)
+            block = self._read_cols(uniq, cols)[inverse]
+            scale = None if self.row_scale is None else self.row_scale[rows]
+        if scale is not None:
+            block = block * scale.reshape(-1, 1)
+        return sp.csr_matrix(block, dtype=np.float32) if sparse else block
+
+    def _col_ranges(self, cols):
+        '''
+        :param cols: sorted gene indices
+        :return: list of (start, stop, positions of cols inside [start, stop)), the column ranges to read:
+            runs of the column chunks of the dataset that hold a selected gene
+        '''
+        chunk = self.values.chunks[1] if self.values.chunks is not None else self.shape[1]
+        chunk_ids = np.unique(cols // chunk)
+        # consecutive chunks are read at once
+        breaks = np.flatnonzero(np.diff(chunk_ids) != 1) + 1
+        ranges = []
+        for run in np.split(chunk_ids, breaks):
+            start, stop = int(run[0]) * chunk, min(int(run[-1] + 1) * chunk, self.shape[1])
+            if self.values.chunks is None:
+                # contiguous layout: read the span of the selected genes only
+                start, stop = int(cols[0]), int(cols[-1]) + 1
+            in_range = cols[(cols >= start) & (cols < stop)]
+            ranges.append((start, stop, in_range - start))
+        return ranges
+
+    def _read_cols(self, rows, cols):
+        '''
+        read rows (slice or sorted index array) and the genes cols, only the column chunks (hdf5 reads and
+        decompresses whole chunks) that hold a selected gene are read, the genes are then picked in numpy
+        (h5py column fancy-indexing reads element by element)
+        '''
+        if cols is None:
+            return self.values[rows]
+        cols = np.asarray(cols)
+        order = None
+        if np.any(np.diff(cols) < 0):
+            order = np.argsort(cols, kind='stable')
+            cols = cols[order]
+        blocks = [self.values[rows, start:stop][:, pos] for start, stop, pos in self._col_ranges(cols)]
+        block = blocks[0] if len(blocks) == 1 else np.concatenate(blocks, axis=1)
+        if order is not None:
+            block = block[:, np.argsort(order, kind='stable')]
+        return block
+
+    def iter_blocks(self, cols=None, sparse=False):
+        '''
+        :return: iterator of (start row, block)
+        '''
+        for start in range(0, self.shape[0], self.block_size):
+            yield start, self.read(slice(start, start + self.block_size), cols, sparse=sparse)
+
+    def row_sums(self, cols=None):
+        return np.concatenate([np.asarray(block.sum(axis=1)).reshape(-1)
+                               for _, block in self.iter_blocks(cols=cols)])
+
+
+def f_classif_h5(data, labels):
+    '''
+    ANOVA F-value of every gene (sklearn f_classif), accumulated block by block over a H5Matrix
+    :return: F-values, ndarray (genes,)
+    '''
+    classes, y = np.unique(labels, return_inverse=True)
+    n_samples = np.bincount(y).astype(np.float64)
+    class_sums = np.zeros((classes.shape[0], data.shape[1]))
+    ss_alldata = np.zeros(data.shape[1])
+    for start, block in data.iter_blocks():
+        block = block.astype(np.float64)
+        y_block = y[start:start + block.shape[0]]
+        onehot = sp.csr_matrix((np.ones(y_block.shape[0]), (y_block, np.arange(y_block.shape[0]))),
+                               shape=(classes.shape[0], y_block.shape[0]))
+        class_sums += onehot @ block
+        ss_alldata += (block ** 2).sum(axis=0)
+
+    n = n_samples.sum()
+    square_of_sums_alldata = class_sums.sum(axis=0) ** 2
+    ssbn = (class_sums ** 2 / n_samples.reshape(-1, 1)).sum(axis=0) - square_of_sums_alldata / n
+    sstot = ss_alldata - square_of_sums_alldata / n
+    sswn = sstot - ssbn
+    msb = ssbn / (classes.shape[0] - 1)
+    msw = sswn / (n - classes.shape[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return msb / msw
+
+
+def read_data_label_h5(path, key, sparse=False, lazy=False):
+    '''
+    :param sparse: return the expression data as a float32 csr_matrix
+    :param lazy: return the expression data as a H5Matrix, read on demand. It keeps data.h5 open until it is closed
+        (or used as a context manager). mean_norm, sel_feature, MVCCModel.predict and predict_chunked take it,
+        the other functions need it read into memory first (H5Matrix.read)
+    '''
     print('Reading data...')
     data_path = os.path.join(path, 'data.h5')
 
-    data_df = pd.read_hdf(data_path, key + '/data')
-    data = data_df.to_numpy()
+    data = H5Matrix(path, key + '/data') if lazy else read_matrix_h5(data_path, key + '/data', sparse=sparse)
+    if data is None:
+        data_df = pd.read_hdf(data_path, key + '/data')
+        data = data_df.to_numpy()
+        if sparse:
+            data = sp.csr_matrix(data, dtype=np.float32)
 
     label_df = pd.read_hdf(data_path, key + '/label')
     # print(label_df['type'].value_counts())
@@ -264,24 +680,83 @@ def read_data_label_h5(path, key):
 
 
 
-def read_similarity_mat_h5(path, key):
+def write_similarity_mat_h5(path, key, similarity_mat, k=None, block_size=2048):
+    '''
+    write a similarity matrix into data.h5 in a compact format
+    :param similarity_mat: ndarray, scipy.sparse matrix or h5py dataset (cells * cells)
+    :param k: keep the top k weights of every row (format 'topk'),
+        None keeps the whole matrix as float32 (format 'dense')
+    '''
+    data_path = os.path.join(path, 'data.h5')
+    n = similarity_mat.shape[0]
+    with h5py.File(data_path, 'a') as f:
+        if key in f:
+            del f[key]
+        group = f.create_group(key)
+        group.attrs['n_cols'] = similarity_mat.shape[1]
+        if k is not None:
+            k_idx, k_weight = top_k_neighbors(similarity_mat, k, block_size=block_size)
+            group.attrs['mvcc_format'] = 'topk'
+            group.create_dataset('indices', data=k_idx.astype(np.int32), compression='gzip')
+            group.create_dataset('weights', data=k_weight.astype(np.float32), compression='gzip')
+        else:
+            group.attrs['mvcc_format'] = 'dense'
+            values = group.create_dataset('values', shape=similarity_mat.shape, dtype=np.float32,
+                                          chunks=(min(n, 256), similarity_mat.shape[1]), compression='gzip')
+            for start in range(0, n, block_size):
+                block = similarity_mat[start:start + block_size]
+                values[start:start + block_size] = block.toarray() if sp.issparse(block) else block
+
+
+def read_similarity_mat_h5(path, key, dtype=None):
+    '''
+    :param key: e.g. ref_1/sm_1
+    :param dtype: cast the weights, None keeps the stored dtype
+    :return: scipy.sparse.csr_matrix for the 'topk' format, ndarray for a dense matrix
+    '''
     # print("reading graph...")
     data_path = os.path.join(path, 'data.h5')
-    mat_df = pd.read_hdf(data_path, key)
+    with h5py.File(data_path, 'r') as f:
+        mat_format = _h5_format(f, key)
+        if mat_format == 'topk':
+            k_idx = f[key]['indices'][:]
+            k_weight = f[key]['weights'][:]
+            n_cols = int(f[key].attrs['n_cols'])
+            rows = np.repeat(np.arange(k_idx.shape[0]), k_idx.shape[1])
+            valid = k_idx.reshape(-1) >= 0
+            similarity_mat = sp.csr_matrix((k_weight.reshape(-1)[valid], (rows[valid], k_idx.reshape(-1)[valid])),
+                                           shape=(k_idx.shape[0], n_cols))
+            return similarity_mat if dtype is None else similarity_mat.astype(dtype)
+        if mat_format == 'dense':
+            similarity_mat = f[key]['values'][:]
+            return similarity_mat if dtype is None else similarity_mat.astype(dtype)
 
-    # print(mat_df.isnull().any())
-    #
-    # print(np.isnan(mat_df).any())
-    # print(np.isinf(mat_df).all())
-    #
-    # print(np.isfinite(mat_df).all())
+    mat_df = pd.read_hdf(data_path, key)
     similarity_mat = mat_df.to_numpy()
     # print("Finish")
-    return similarity_mat.astype(np.float64)
+    return similarity_mat if dtype is None else similarity_mat.astype(dtype)
 
 
 def sel_feature(data1, data2, label1, nf=3000):
-        
+    '''
+    :param data1, data2: ndarray, scipy.sparse matrix or H5Matrix, only the selected genes of a H5Matrix are read,
+        a H5Matrix is closed once they are read
+    '''
+    if isinstance(data1, H5Matrix):
+        scores = f_classif_h5(data1, label1)
+        # same choice as SelectKBest: nan scores come last, ties are broken by the stable sort
+        scores[np.isnan(scores)] = np.finfo(scores.dtype).min
+        idx = np.sort(np.argsort(scores, kind="mergesort")[-nf:])
+        with data1:
+            data1 = data1.read(cols=idx)
+        if isinstance(data2, H5Matrix):
+            with data2:
+                data2 = data2.read(cols=idx)
+        else:
+            data2 = data2[:, idx]
+        print("After gene selction , ref data shape {:}, query data shape {:}".format(data1.shape, data2.shape))
+        return data1, data2
+
     sel_model = SelectKBest(k=nf)  # default score function is f_classif
 
     sel_model.fit(data1, label1)
@@ -290,6 +765,8 @@ def sel_feature(data1, data2, label1, nf=3000):
     # idx = list(set(idx1) & set(idx2))
     data1 = data1[:, idx]
     data2 = data2[:, idx]
+    if sp.issparse(data1):
+        data1, data2 = data1.tocsr(), data2.tocsr()
     print("After gene selction , ref data shape {:}, query data shape {:}".format(data1.shape, data2.shape))
 
     return data1, data2
@@ -308,35 +785,154 @@ def pre_process(data1, data2, label1, nf=2000):
     return data1, data2
 
 
+class ClassPrototypes(object):
+    def __init__(self, h, labels, n_prototypes=1, n_iters=10, seed=0, device='cpu'):
+        '''
+        class prototypes of the reference latents, built once and scored against queries in batches
+        n_prototypes = 1: the class means, q . mean_c is exactly the mean similarity of q to the cells of class c
+        n_prototypes > 1: k-means centers of every class, a class scores its most similar center
+        :param h: reference latents (cells * lsd), ndarray or tensor
+        :param labels: reference labels (cells)
+        '''
+        h = torch.as_tensor(h, dtype=torch.float, device=device)
+        labels = torch.as_tensor(labels, device=device).view(-1).long()
+        self.n_prototypes = n_prototypes
+        self.classes, inverse, counts = torch.unique(labels, return_inverse=True, return_counts=True)
+        class_num = self.classes.shape[0]
+        means = torch.zeros((class_num, h.shape[1]), device=device).index_add_(0, inverse, h)
+        means = means / counts.view(-1, 1)
+        if n_prototypes == 1:
+            self.prototypes = means
+            return
+
+        generator = torch.Generator(device='cpu').manual_seed(seed)
+        prototypes = means.repeat_interleave(n_prototypes, dim=0)
+        for c in range(class_num):
+            data = h[inverse == c]
+            p = min(n_prototypes, data.shape[0])
+            centers = data[torch.randperm(data.shape[0], generator=generator)[:p].to(device)]
+            for it in range(n_iters):
+                assign = torch.cdist(data, centers).argmin(dim=1)
+                sums = torch.zeros_like(centers).index_add_(0, assign, data)
+                sizes = torch.bincount(assign, minlength=p).view(-1, 1)
+                centers = torch.where(sizes > 0, sums / sizes.clamp(min=1), centers)
+            # classes with less cells than prototypes repeat their last center
+            prototypes[c * n_prototypes:(c + 1) * n_prototypes] = centers[torch.arange(n_prototypes, device=device).clamp(max=p - 1)]
+        self.prototypes = prototypes
+
+    def to(self, device):
+        self.classes = self.classes.to(device)
+        self.prototypes = self.prototypes.to(device)
+        return self
+
+    def scores(self, query, batch_size=65536):
+        '''
+        :param query: latents (cells * lsd), ndarray or tensor
+        :return: tensor (cells * classes), the score of every class, in the order of self.classes
+        '''
+        query = torch.as_tensor(query, dtype=torch.float, device=self.prototypes.device)
+        scores = []
+        for start in range(0, query.shape[0], batch_size):
+            score = torch.mm(query[start:start + batch_size], self.prototypes.t())
+            if self.n_prototypes > 1:
+                score = score.view(score.shape[0], -1, self.n_prototypes).max(dim=2)[0]
+            scores.append(score)
+        return torch.cat(scores, dim=0)
+
+    def predict(self, query, return_scores=False, batch_size=65536):
+        '''
+        :return: predicted labels (tensor), and the scores if return_scores
+        '''
+        scores = self.scores(query, batch_size)
+        pred = self.classes[scores.argmax(dim=1)]
+        if return_scores:
+            return pred, scores
+        return pred
+
+
 def cpm_classify(lsd1, lsd2, label):
     """In most cases, this method is used to predict the highest accuracy.
     :param lsd1: train set's latent space data
     :param lsd2: test set's latent space data
     :param label: label of train set
-    :return: Predicted label
+    :return: Predicted label, index of the class among the sorted labels of the train set
     """
-    F_h_h = np.dot(lsd2, np.transpose(lsd1))
-    label = label.reshape(len(label), 1)
-    enc = OneHotEncoder()
-    a = enc.fit_transform(label)
-    # print(a)
-    label_onehot = a.toarray()
-    label_num = np.sum(label_onehot, axis=0)
-    F_h_h_sum = np.dot(F_h_h, label_onehot)
-    F_h_h_mean = F_h_h_sum / label_num
-    label_pre = np.argmax(F_h_h_mean, axis=1)
-    return label_pre
-
-
-def runUMAP(data):
-    umap_model = umap.UMAP(random_state=0)
+    # mean similarity to the cells of a class = similarity to the class mean, no test * train matrix
+    _, label_idx = np.unique(np.asarray(label).reshape(-1), return_inverse=True)
+    prototypes = ClassPrototypes(lsd1, label_idx)
+    label_pre = prototypes.scores(lsd2).argmax(dim=1)
+    return label_pre.cpu().numpy()
+
+
+def hash_array(data, *params):
+    '''
+    :param data: ndarray or scipy.sparse matrix
+    :param params: anything else the result depends on
+    :return: hex digest of the content of data and params
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    h.update('{:}_{:}_{:}'.format(data.shape, data.dtype, params).encode())
+    if sp.issparse(data):
+        data = data.tocsr()
+        for arr in (data.indptr, data.indices, data.data):
+            h.update(np.ascontiguousarray(arr).view(np.uint8))
+    else:
+        h.update(np.ascontiguousarray(data).view(np.uint8))
+    return h.hexdigest()
+
+
+def runUMAP(data, n_pca=50, cache_dir=None, seed=0):
+    '''
+    :param data: ndarray or scipy.sparse matrix (cells * features)
+    :param n_pca: reduce to n_pca principal components before UMAP, None runs UMAP on data itself
+    :param cache_dir: 2-d embeddings are cached there as <hash of data and parameters>.npy, None disables the cache
+    :return: ndarray (cells * 2)
+    '''
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'umap_' + hash_array(data, n_pca, seed) + '.npy')
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
+    if n_pca is not None and data.shape[1] > n_pca:
+        data = runPCA(data, n_pca, seed)
+    # umap is slow to import, only the visualisation needs it
+    import umap
+    umap_model = umap.UMAP(random_state=seed)
     data_2d = umap_model.fit_transform(data)
+
+    if cache_file is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # np.save appends .npy to the temporary name
+        np.save(cache_file + '.tmp', data_2d)
+        os.replace(cache_file + '.tmp.npy', cache_file)
     return data_2d
 
 
-def runPCA(data):
-    pca = PCA(n_components=32)
-    return pca.fit_transform(data)
+def runPCA(data, n_components=32, seed=0):
+    '''
+    :param data: ndarray or scipy.sparse matrix (cells * features), sparse data is never densified
+    '''
+    n_components = min(n_components, min(data.shape) - 1)
+    if sp.issparse(data):
+        pca = PCA(n_components=n_components, svd_solver='arpack', random_state=seed)
+        return pca.fit_transform(data.astype(np.float32))
+    pca = PCA(n_components=n_components, svd_solver='randomized', random_state=seed)
+    return pca.fit_transform(np.asarray(data, dtype=np.float32))
+
+
+def stratified_subsample(labels, max_cells, seed=0):
+    '''
+    cells to plot: about max_cells of them, the class proportions of labels are kept, every class keeps a cell
+    :return: sorted cell indices (all cells if max_cells is None or not smaller than the number of cells)
+    '''
+    labels = np.asarray(labels).reshape(-1)
+    if max_cells is None or labels.shape[0] <= max_cells:
+        return np.arange(labels.shape[0])
+    idx = stratified_batches(labels, max_cells, np.random.default_rng(seed))[0]
+    _, first = np.unique(labels, return_index=True)
+    return np.union1d(idx, first)
 
 
 def show_cluster(data, label, title, save_path):
@@ -346,57 +942,47 @@ def show_cluster(data, label, title, save_path):
     :param label: 
     :param title: title for plot
     '''
-    save_path = os.path.join(save_path, 'image')
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    data = {
-        'x': data[:, 0],
-        'y': data[:, 1],
-        'label': label
-    }
-
-    df = pd.DataFrame(data=data)    
-    # df = df[~((df['x']>10) | (df['y']>10))]
-
-    plt.figure(figsize=(8, 6))
-    sns.scatterplot(data=df, x='x', y='y', hue='label', palette='deep', s=3)
-    plt.legend(loc=3, bbox_to_anchor=(1, 0))  
-    plt.xlabel('UMAP1')
-    plt.ylabel('UMAP2')
-    plt.title(title)
-    plt.savefig(os.path.join(save_path, "_".join(title.split()) + '.png'), bbox_inches='tight')  # dpi可以设置
-    
+    plot_cluster(data, label, title, save_path)
 
 
 def concat_views(views):
     return np.concatenate(views, axis=1).astype(np.float64)
 
 
-def batch_mixing_entropy(ref_data, query_data, L=100, M=300, K=500):
+def batch_mixing_entropy(ref_data, query_data, L=100, M=300, K=500, kdtree=None, workers=1, block_size=4096):
     '''
     :param ref_data:
     :param query_data:
     :param L: times
     :param M: number of randomly sampling cells
     :param k: number of neigbors
+    :param kdtree: scipy.spatial.cKDTree of the concatenated ref_data and query_data, reused if given
+    :param workers: threads of the neighbor queries, -1 uses all cores
+    :param block_size: cells queried at once (memory: block_size * K indices)
     :return: list of batch entropy, representing results of L randomly sampling
     '''
     data = np.concatenate([ref_data, query_data], axis=0)
     nbatchs = 2
-    batch0 = np.concatenate([np.zeros(ref_data.shape[0]), np.ones(query_data.shape[0])])
-    entropy = [0 for i in range(L)]
-    kdtree = spt.KDTree(data)
+    batch0 = np.concatenate([np.zeros(ref_data.shape[0], dtype=np.int64), np.ones(query_data.shape[0], dtype=np.int64)])
+    if kdtree is None:
+        kdtree = spt.cKDTree(data)
     random.seed(0)
     data_idx = [p for p in range(data.shape[0])]
-    for boot in range(L):
-        rand_samples_idx = sample(data_idx, M)
-        _, neighbor_idx = kdtree.query(data[rand_samples_idx, :], k=K)
-        for i in range(len(rand_samples_idx)):
-            for j in range(nbatchs):
-                xi = max(1, (batch0[neighbor_idx[i]] == j).sum())
-                entropy[boot] += xi * math.log(xi)
-    entropy = [-(x / M) for x in entropy]
+    # same random sequence as sampling round by round, so the results stay comparable
+    rand_samples_idx = np.array([sample(data_idx, M) for boot in range(L)])
+
+    # the rounds draw the same cells again and again, the entropy term of a cell only depends on its neighbors:
+    # query every drawn cell once and sum the terms per round
+    cells, inverse = np.unique(rand_samples_idx, return_inverse=True)
+    cell_entropy = np.zeros(cells.shape[0])
+    for start in range(0, cells.shape[0], block_size):
+        _, neighbor_idx = kdtree.query(data[cells[start:start + block_size], :], k=K, workers=workers)
+        neighbor_batch = batch0[neighbor_idx.reshape(neighbor_idx.shape[0], -1)]
+        for j in range(nbatchs):
+            xi = np.maximum(1, (neighbor_batch == j).sum(axis=1))
+            cell_entropy[start:start + block_size] += xi * np.log(xi)
+    entropy = cell_entropy[inverse.reshape(-1)].reshape(L, M).sum(axis=1)
+    entropy = [-(x / M) for x in entropy.tolist()]
     return entropy
 
 
@@ -409,8 +995,8 @@ def encode_label(ref_label, query_label):
 
 
 def precision_of_cell(cell_type, pred, trues):
-    idx = np.array(np.where(trues == cell_type)).squeeze()
-    acc = (pred[idx] == cell_type).sum() / len(idx)
+    idx = trues == cell_type
+    acc = (pred[idx] == cell_type).sum() / idx.sum()
     return acc
 
 
@@ -418,55 +1004,18 @@ def precision_of_cell(cell_type, pred, trues):
 def confusion_plot(pred, true, save_name):
     print(accuracy_score(pred, true))
 
-    name = list(set(true))
-    name = [x.lower() for x in name]
-    # if not "unassigned" in name:
-    #     name.append("unassigned")
-    name.sort()
-
-    name_idx = {}
-    for i in range(len(name)):
-        name_idx[name[i]] = i
-
-    confusion_mat = []
+    # labels are compared in lower case, columns are the true types
+    name, true_codes = encode_labels(true, lower=True)
     print(set(true))
     print(set(name))
-    
-    for i in range(len(set(true))):
-        confusion_mat.append([0 for j in range(len(name))])
-
-    pred = list(pred)
-    true = list(true)
+    _, pred_codes = encode_labels(pred, name, lower=True)
 
-    pred = [x.lower() for x in pred]
-    true = [x.lower() for x in true]
-
-    for i in range(len(true)):
-        row = name_idx[true[i]]
-        col = name_idx[pred[i]]
-        confusion_mat[row][col] += 1
-    
-    confusion_mat = np.array(confusion_mat)    
-    confusion_mat = confusion_mat / np.sum(confusion_mat, axis=1).reshape(-1, 1)
-    data_df = pd.DataFrame(
-        confusion_mat
-    )
-    data_df.columns = name
-    true_name = list(set(true))
-    true_name.sort()
-    data_df.index = true_name
-
-    
-    data_df = data_df.reindex(index=data_df.index[::-1])
+    confusion_mat = row_normalize(confusion_matrix(true_codes, pred_codes, name.shape[0]))
+    data_df = plot_matrix(confusion_mat, name, name, save_name, cbar=False, dpi=600, reverse_rows=True)
 
     print(data_df.index)
     print(data_df.columns)
 
-    sns.heatmap(data=data_df, cmap="Blues", cbar=False, xticklabels=True, yticklabels=True)
-    plt.savefig(save_name, dpi=600, bbox_inches="tight")
-    plt.clf()
-    # plt.show()
-
 
 def precision_with_FPR(trues, pred, prob, FPR=0.05):    
     unknown_idx = np.where(trues == 'unknown')[0]
@@ -490,7 +1039,17 @@ def precision_with_FPR(trues, pred, prob, FPR=0.05):
     return accuracy_score(trues, pred)
 
 
-def show_result(ret, save_path):
+def show_result(ret, save_path, plot=True, max_plot_cells=None, n_pca=50, cache_dir=None, plot_workers=0):
+    '''
+    report the accuracy, write the csv outputs and (optionally) the figures
+    :param plot: draw the confusion plot and the UMAP figures, the csv outputs are written either way
+    :param max_plot_cells: plot a stratified subsample (by batch and true label) of about this many cells,
+        the csv outputs always hold all cells
+    :param n_pca: principal components computed before UMAP, None runs UMAP on the raw data / embeddings
+    :param cache_dir: cache of the 2-d embeddings, None is save_path/cache
+    :param plot_workers: processes rendering the figures, 0 renders them in this process, None is one per figure
+        (see MVCC.plotting.plot_clusters, the calling script needs an if __name__ == '__main__' guard)
+    '''
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
@@ -511,12 +1070,14 @@ def show_result(ret, save_path):
     # f1 = f1_score(ret['query_label'], ret['pred'], average='macro')
 
     
-    cell_types = set(ret['query_label'])
-    for c_t in cell_types:
-        print("{:} accuracy is {:.3f}".format(c_t, precision_of_cell(c_t, ret['pred'], ret['query_label'])))
+    metrics = class_metrics(ret['query_label'], ret['pred'])
+    for c_t, c_acc in zip(metrics['classes'], metrics['per_class_accuracy']):
+        if not np.isnan(c_acc):
+            print("{:} accuracy is {:.3f}".format(c_t, c_acc))
 
     print("Prediction Accuracy is {:.3f}".format(acc))
-    confusion_plot(ret['pred'], ret['query_label'], save_name=os.path.join(save_path, 'pred_confusion_plot.png'))
+    if plot:
+        confusion_plot(ret['pred'], ret['query_label'], save_name=os.path.join(save_path, 'pred_confusion_plot.png'))
 
         
     
@@ -524,23 +1085,28 @@ def show_result(ret, save_path):
     
     trues_after_shuffle = np.concatenate([ret['ref_label'], ret['query_label']]).reshape(-1)
     all_preds = np.concatenate([ret['ref_label'], ret['pred']]).reshape(-1)
-    raw_data = np.concatenate([ret['ref_raw_data'], ret['query_raw_data']], axis=0)
-    
-    raw_data_2d = runUMAP(raw_data)
-    h_data_2d = runUMAP(joint_embedding)
-    
-    show_cluster(raw_data_2d, raw_trues, 'reference-query raw true label', save_path)
-    show_cluster(h_data_2d, trues_after_shuffle, 'reference-query h true label', save_path)
-    show_cluster(h_data_2d, all_preds, 'reference-query h pred label', save_path)
-    show_cluster(raw_data_2d,
-                 ["reference" for i in range(ref_h.shape[0])] + ["query" for i in range(query_h.shape[0])],
-                 "raw batches",
-                 save_path)
-    show_cluster(h_data_2d,
-                 ["reference" for i in range(ref_h.shape[0])] + ["query" for i in range(query_h.shape[0])],
-                 "h batches",
-                 save_path)
+    if sp.issparse(ret['ref_raw_data']):
+        raw_data = sp.vstack([ret['ref_raw_data'], ret['query_raw_data']], format='csr')
+    else:
+        raw_data = np.concatenate([ret['ref_raw_data'], ret['query_raw_data']], axis=0)
     
+    if cache_dir is None:
+        cache_dir = os.path.join(save_path, 'cache')
+    raw_data_2d = runUMAP(raw_data, n_pca=n_pca, cache_dir=cache_dir)
+    h_data_2d = runUMAP(joint_embedding, n_pca=n_pca, cache_dir=cache_dir)
+
+    if plot:
+        batches = np.array(["reference"] * ref_h.shape[0] + ["query"] * query_h.shape[0])
+        idx = stratified_subsample(np.char.add(batches, np.char.add('|', trues_after_shuffle.astype(str))),
+                                   max_plot_cells)
+        plot_clusters([
+            (raw_data_2d[idx], raw_trues[idx], 'reference-query raw true label', save_path),
+            (h_data_2d[idx], trues_after_shuffle[idx], 'reference-query h true label', save_path),
+            (h_data_2d[idx], all_preds[idx], 'reference-query h pred label', save_path),
+            (raw_data_2d[idx], batches[idx], "raw batches", save_path),
+            (h_data_2d[idx], batches[idx], "h batches", save_path),
+        ], workers=plot_workers)
+
     query_preds = pd.DataFrame(data=ret['pred'], columns=['type'])
     query_labels = pd.DataFrame(data=ret['query_label'], columns=['type'])
     all_preds = pd.DataFrame(data=all_preds, columns=['type'])
@@ -8,6 +8,8 @@ from MVCC.util import mean_norm, construct_graph_with_knn, \
     read_data_label_h5, read_similarity_mat_h5, encode_label, show_result, pre_process, z_score_scale, \
     check_out_similarity_matrix, construct_graph, setup_seed
 from MVCC.model import MVCCModel
+from MVCC.bundle import load_bundle
+from MVCC.graph_cache import GraphCache
 import numpy as np
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import accuracy_score
@@ -36,6 +38,7 @@ parameter_config = {
     'mask_rate': 0.3,
     'gamma': 1,
     'show_result': True,
+    'sparse': False,  # keep the expression data as csr_matrix from reading to the GCN input
     'views': [1, 2, 3]
 }
 
@@ -49,14 +52,20 @@ def main_process():
     # random seed setting
     setup_seed(20)
 
-    ref_data, ref_label = read_data_label_h5(data_config['root_path'], data_config['ref_key'])
-    query_data, query_label = read_data_label_h5(data_config['root_path'], data_config['query_key'])
-    ref_data = ref_data.astype(np.float64)
-    query_data = query_data.astype(np.float64)
+    ref_data, ref_label = read_data_label_h5(data_config['root_path'], data_config['ref_key'],
+                                             sparse=parameter_config['sparse'])
+    query_data, query_label = read_data_label_h5(data_config['root_path'], data_config['query_key'],
+                                                 sparse=parameter_config['sparse'])
+    if not parameter_config['sparse']:
+        ref_data = ref_data.astype(np.float64)
+        query_data = query_data.astype(np.float64)
 
     ref_norm_data = ref_data
     query_norm_data = query_data
 
+    # MNN graphs are cached next to data.h5 and reused by fit, predict and later runs
+    graph_cache = GraphCache(os.path.join(data_config['root_path'], 'graph_cache'))
+
     # similarity matrices
     ref_sm_arr = [read_similarity_mat_h5(data_config['root_path'], data_config['ref_key'] + "/sm_" + str(i + 1)) for i
                   in
@@ -67,7 +76,9 @@ def main_process():
 
     if parameter_config['exp_mode'] == 2:
         # multi ref
-        mvccmodel = torch.load('model/mvccmodel_' + data_config['query_key'] + ".pt")
+        # the bundle written by the last fit
+        mvccmodel = load_bundle(os.path.join(data_config['root_path'], 'model', 'bundle'),
+                                save_path=data_config['root_path'])
         ref_label, query_label = mvccmodel.label_encoder.transform(ref_label), mvccmodel.label_encoder.transform(
             query_label)
         enc = mvccmodel.label_encoder
@@ -93,18 +104,21 @@ def main_process():
                   mask_rate=parameter_config['mask_rate'],
                   exp_mode=parameter_config['exp_mode'],
                   k_neighbor=parameter_config['k_neighbor'],
-                  classifier_name=parameter_config['classifier_name']
+                  classifier_name=parameter_config['classifier_name'],
+                  graph_cache=graph_cache
                   )
 
     pred = mvccmodel.predict(query_norm_data, query_sm_arr, parameter_config['epoch_cpm_query'],
-                             k_neighbor=parameter_config['k_neighbor'])
+                             k_neighbor=parameter_config['k_neighbor'], graph_cache=graph_cache)
 
     ref_raw_label = enc.inverse_transform(ref_label)
 
     # GCN embeddings
-    ref_graph_data = construct_graph(ref_norm_data, ref_sm_arr[0], k=parameter_config['k_neighbor'])
+    ref_graph_data = construct_graph(ref_norm_data, ref_sm_arr[0], k=parameter_config['k_neighbor'],
+                                     graph_cache=graph_cache)
     ref_gcn_embeddings = z_score_scale(mvccmodel.gcn_models[0].get_embedding(ref_graph_data).detach().cpu().numpy())
-    query_graph_data = construct_graph(query_norm_data, query_sm_arr[0], k=parameter_config['k_neighbor'])
+    query_graph_data = construct_graph(query_norm_data, query_sm_arr[0], k=parameter_config['k_neighbor'],
+                                       graph_cache=graph_cache)
     query_gcn_embeddings = z_score_scale(mvccmodel.gcn_models[0].get_embedding(query_graph_data).detach().cpu().numpy())
 
     ref_out, ref_label = mvccmodel.get_ref_embeddings_and_labels()
@@ -136,6 +150,7 @@ def main_process():
     return ret
 
 
-ret = main_process()
-acc = accuracy_score(ret['pred'], ret['query_label'])
-print("pred acc is {:.3f}".format(acc))
+if __name__ == '__main__':
+    ret = main_process()
+    acc = accuracy_score(ret['pred'], ret['query_label'])
+    print("pred acc is {:.3f}".format(acc))
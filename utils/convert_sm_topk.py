@@ -0,0 +1,66 @@
+"""
+    one-time conversion of the dense similarity matrices (sm_*) of an existing data.h5
+    into the compact top k format (or float32 dense with --dense)
+    every other key is copied as it is, the converted file replaces data.h5 at the end
+"""
+
+import os
+import sys
+import re
+import argparse
+import h5py
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MVCC.util import write_similarity_mat_h5
+
+
+parser = argparse.ArgumentParser(description='[MVCC]')
+parser.add_argument('--path', type=str, required=True, help='directory of data.h5')
+parser.add_argument('--k', default=50, type=int, required=False, help='number of neighbors kept per cell, '
+                                                                       'should not be smaller than k_neighbor')
+parser.add_argument('--dense', action='store_true', help='keep the whole matrix as float32 instead of top k')
+args = parser.parse_args()
+
+data_path = os.path.join(args.path, 'data.h5')
+tmp_dir = os.path.join(args.path, 'convert_tmp')
+if not os.path.exists(tmp_dir):
+    os.makedirs(tmp_dir)
+tmp_path = os.path.join(tmp_dir, 'data.h5')
+if os.path.exists(tmp_path):
+    os.remove(tmp_path)
+
+src = h5py.File(data_path, 'r')
+with h5py.File(tmp_path, 'w') as dst:
+    for name, value in src.attrs.items():
+        dst.attrs[name] = value
+
+for group_name in src:
+    with h5py.File(tmp_path, 'a') as dst:
+        parent = dst.require_group(group_name)
+        for attr_name, value in src[group_name].attrs.items():
+            parent.attrs[attr_name] = value
+
+    for name in src[group_name]:
+        key = group_name + '/' + name
+        node = src[key]
+        if re.fullmatch(r'sm_\d+', name) is None or 'mvcc_format' in node.attrs:
+            with h5py.File(tmp_path, 'a') as dst:
+                src.copy(node, dst[group_name], name=name)
+            continue
+
+        print("converting " + key)
+        if node.attrs.get('nblocks', 0) == 1 and 'block0_values' in node:
+            # pandas fixed format with a single float block, read it row block by row block
+            similarity_mat = node['block0_values']
+        else:
+            similarity_mat = pd.read_hdf(data_path, key).to_numpy()
+        write_similarity_mat_h5(tmp_dir, key, similarity_mat, k=None if args.dense else args.k)
+
+src.close()
+os.replace(tmp_path, data_path)
+os.rmdir(tmp_dir)
+
+print("data.h5 keys are:")
+with h5py.File(data_path, 'r') as f:
+    f.visit(lambda name: print(name) if isinstance(f[name], h5py.Group) else None)
@@ -1,109 +1,163 @@
 """
-    automatically transform csv to h5 data    
-    output expression data is cell * gene 
+    automatically transform csv to h5 data
+    output expression data is cell * gene
+
+    --chunksize > 0 streams every data/sm csv in row chunks into appendable, compressed float32 datasets,
+    independent files are converted by --workers processes, each into its own part file,
+    the parts are merged into data.h5 at the end
 """
 
 import os
+import sys
+import time
+import numpy as np
 import pandas as pd
 import argparse
+import h5py
+from concurrent.futures import ProcessPoolExecutor
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MVCC.util import write_similarity_mat_h5, top_k_neighbors
 
-parser = argparse.ArgumentParser(description='[MVCC]')
-parser.add_argument('--path', type=str, required=False, help='working directory')
-parser.add_argument('--subpath', default='raw_data', type=str, required=False, help='data or rawdata')
-args = parser.parse_args()
-
-# args.path = r'..\experiment\multi_ref\MCA_liver'
-data_path = os.path.join(args.path, args.subpath)
-# data_path = os.path.join(args.path, 'raw_data')
-ref_path = os.path.join(data_path, 'ref')
-query_path = os.path.join(data_path, 'query')
-
-
-# model_path = os.path.join(args.path, 'MVCC')
-# result_path = os.path.join(args.path, 'result')
-
-'''
-    ref
-'''
-print("path is "+args.path)
-print("Start to process ref data")
-assert len(os.listdir(ref_path)) != 0
-data_file_arr = []
-label_file_arr = []
-sm_file_arr = []
-for file in os.listdir(ref_path):
-    if 'data' in file.split('_'):
-        data_file_arr.append(file)
-    elif 'label' in file.split('_'):
-        label_file_arr.append(file)
-    elif 'sm' in file.split('_'):
-        sm_file_arr.append(file)
-
-data_file_arr.sort()
-label_file_arr.sort()
-sm_file_arr.sort()
-
-# 读取csv数据，然后转为h5
-for i in range(len(data_file_arr)):
-    df = pd.read_csv(os.path.join(ref_path, data_file_arr[i]), index_col=0)
-    df.to_hdf(os.path.join(args.path, 'data.h5'), 'ref_'+data_file_arr[i].split('.')[0].split('_')[1]+'/data')
-
-for i in range(len(label_file_arr)):
-    df = pd.read_csv(os.path.join(ref_path, label_file_arr[i]))
-    df.to_hdf(os.path.join(args.path, 'data.h5'), 'ref_'+label_file_arr[i].split('.')[0].split('_')[1]+'/label')
-
-
-for i in range(len(sm_file_arr)):
-    print(os.path.join(ref_path, sm_file_arr[i]))
-    df = pd.read_csv(os.path.join(ref_path, sm_file_arr[i]), index_col=0)
-    # sm的命名规则为 sm_1_1.csv , 中间的1代表是ref_1, 后面的1代表的是view 1
-    name = sm_file_arr[i]
-    name = name.split('.')[0].split('_')
-    df.to_hdf(os.path.join(args.path, 'data.h5'), 'ref_'+name[1]+'/sm_'+name[2])
-
-
-'''
-    query
-'''
-print("Start to process query data")
-assert len(os.listdir(query_path)) != 0
-data_file_arr = []
-label_file_arr = []
-sm_file_arr = []
-for file in os.listdir(query_path):
-    if 'data' in file.split('_'):
-        data_file_arr.append(file)
-    elif 'label' in file.split('_'):
-        label_file_arr.append(file)
-    elif 'sm' in file.split('_'):
-        sm_file_arr.append(file)
-
-data_file_arr.sort()
-label_file_arr.sort()
-sm_file_arr.sort()
-
-
-for i in range(len(data_file_arr)):
-    df = pd.read_csv(os.path.join(query_path, data_file_arr[i]), index_col=0)
-    df.to_hdf(os.path.join(args.path, 'data.h5'), 'query_' + data_file_arr[i].split('.')[0].split('_')[1] + '/data')
-
-for i in range(len(label_file_arr)):
-    df = pd.read_csv(os.path.join(query_path, label_file_arr[i]))
-    df.to_hdf(os.path.join(args.path, 'data.h5'), 'query_' + label_file_arr[i].split('.')[0].split('_')[1] + '/label')
-
-for i in range(len(sm_file_arr)):
-    df = pd.read_csv(os.path.join(query_path, sm_file_arr[i]), index_col=0)
-    # rule of sm file is sm_1_1 , the midlle 1 represents ref_1, the last 1 represents view 1
-    print("query sm shape ", df.shape)
-    name = sm_file_arr[i]
-    name = name.split('.')[0].split('_')
-    df.to_hdf(os.path.join(args.path, 'data.h5'), 'query_' + name[1] + '/sm_' + name[2])
 
+def write_sm(args, df, key):
+    if args.sm_format == 'pandas':
+        df.to_hdf(os.path.join(args.path, 'data.h5'), key=key)
+    else:
+        write_similarity_mat_h5(args.path, key, df.to_numpy(), k=args.sm_k if args.sm_format == 'topk' else None)
+
+
+def append_rows(dataset, rows):
+    start = dataset.shape[0]
+    dataset.resize(start + rows.shape[0], axis=0)
+    dataset[start:] = rows
+
+
+def stream_csv_to_h5(csv_file, part_file, key, kind, chunksize, sm_k):
+    '''
+    convert one csv in row chunks, only one chunk is in memory at a time
+    :param kind: 'data' or 'sm'
+    :param sm_k: keep the top sm_k weights of every cell for similarity matrices, 0 keeps the dense matrix
+    :return: key, number of rows, seconds
+    '''
+    start_time = time.time()
+    n_rows = 0
+    str_type = h5py.string_dtype()
+    with h5py.File(part_file, 'w') as f:
+        group = f.create_group(key)
+        for chunk in pd.read_csv(csv_file, index_col=0, chunksize=chunksize):
+            values = chunk.to_numpy(dtype=np.float32)
+            if n_rows == 0:
+                n_cols = values.shape[1]
+                group.attrs['n_cols'] = n_cols
+                group.create_dataset('index', shape=(0,), maxshape=(None,), dtype=str_type, chunks=True)
+                if kind == 'sm' and sm_k > 0:
+                    group.attrs['mvcc_format'] = 'topk'
+                    k = min(sm_k, n_cols - 1)
+                    group.create_dataset('indices', shape=(0, k), maxshape=(None, k), dtype=np.int32,
+                                         chunks=(min(chunksize, 1024), k), compression='gzip')
+                    group.create_dataset('weights', shape=(0, k), maxshape=(None, k), dtype=np.float32,
+                                         chunks=(min(chunksize, 1024), k), compression='gzip')
+                else:
+                    group.attrs['mvcc_format'] = 'dense'
+                    group.create_dataset('columns', data=np.array(chunk.columns.astype(str), dtype=object),
+                                         dtype=str_type)
+                    group.create_dataset('values', shape=(0, n_cols), maxshape=(None, n_cols), dtype=np.float32,
+                                         chunks=(min(chunksize, 256), min(n_cols, 512)), compression='gzip')
+
+            append_rows(group['index'], np.array(chunk.index.astype(str), dtype=object))
+            if 'indices' in group:
+                k_idx, k_weight = top_k_neighbors(values, group['indices'].shape[1], row_offset=n_rows)
+                append_rows(group['indices'], k_idx.astype(np.int32))
+                append_rows(group['weights'], k_weight.astype(np.float32))
+            else:
+                append_rows(group['values'], values)
+            n_rows += values.shape[0]
+
+    return key, n_rows, time.time() - start_time
+
+
+def merge_part(h5_file, part_file, key):
+    with h5py.File(part_file, 'r') as src, h5py.File(h5_file, 'a') as dst:
+        if key in dst:
+            del dst[key]
+        parent, name = key.split('/')
+        src.copy(src[key], dst.require_group(parent), name=name)
+    os.remove(part_file)
+
+
+def process_dir(args, dir_path, prefix, jobs):
+    '''
+    :param prefix: 'ref' or 'query'
+    :param jobs: streamed conversions (csv_file, key, kind) are appended here instead of being run
+    '''
+    assert len(os.listdir(dir_path)) != 0
+    data_file_arr = []
+    label_file_arr = []
+    sm_file_arr = []
+    for file in os.listdir(dir_path):
+        if 'data' in file.split('_'):
+            data_file_arr.append(file)
+        elif 'label' in file.split('_'):
+            label_file_arr.append(file)
+        elif 'sm' in file.split('_'):
+            sm_file_arr.append(file)
+
+    data_file_arr.sort()
+    label_file_arr.sort()
+    sm_file_arr.sort()
+
+    # 读取csv数据，然后转为h5
+    for i in range(len(data_file_arr)):
+        key = prefix + '_' + data_file_arr[i].split('.')[0].split('_')[1] + '/data'
+        if args.chunksize > 0:
+            jobs.append((os.path.join(dir_path, data_file_arr[i]), key, 'data'))
+            continue
+        df = pd.read_csv(os.path.join(dir_path, data_file_arr[i]), index_col=0)
+        df.to_hdf(os.path.join(args.path, 'data.h5'), key=key)
+
+    for i in range(len(label_file_arr)):
+        df = pd.read_csv(os.path.join(dir_path, label_file_arr[i]))
+        df.to_hdf(os.path.join(args.path, 'data.h5'),
+                  key=prefix + '_' + label_file_arr[i].split('.')[0].split('_')[1] + '/label')
+
+    for i in range(len(sm_file_arr)):
+        print(os.path.join(dir_path, sm_file_arr[i]))
+        # rule of sm file is sm_1_1 , the midlle 1 represents ref_1, the last 1 represents view 1
+        name = sm_file_arr[i]
+        name = name.split('.')[0].split('_')
+        key = prefix + '_' + name[1] + '/sm_' + name[2]
+        if args.chunksize > 0:
+            jobs.append((os.path.join(dir_path, sm_file_arr[i]), key, 'sm'))
+            continue
+        df = pd.read_csv(os.path.join(dir_path, sm_file_arr[i]), index_col=0)
+        print(prefix + " sm shape ", df.shape)
+        write_sm(args, df, key)
+
+
+def run_jobs(args, jobs):
+    h5_file = os.path.join(args.path, 'data.h5')
+    part_dir = os.path.join(args.path, 'h5_parts')
+    if not os.path.exists(part_dir):
+        os.makedirs(part_dir)
+    sm_k = args.sm_k if args.sm_format == 'topk' else 0
+    part_files = {key: os.path.join(part_dir, key.replace('/', '_') + '.h5') for _, key, _ in jobs}
+
+    start_time = time.time()
+    total_rows = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(stream_csv_to_h5, csv_file, part_files[key], key, kind, args.chunksize, sm_k)
+                   for csv_file, key, kind in jobs]
+        for future in futures:
+            key, n_rows, seconds = future.result()
+            total_rows += n_rows
+            print("{:}: {:} rows in {:.1f}s, {:.0f} rows/sec".format(key, n_rows, seconds, n_rows / max(seconds, 1e-6)))
+            merge_part(h5_file, part_files[key], key)
+
+    seconds = time.time() - start_time
+    print("total: {:} rows in {:.1f}s, {:.0f} rows/sec".format(total_rows, seconds, total_rows / max(seconds, 1e-6)))
+    os.rmdir(part_dir)
 
-import h5py
-print("data.h5 keys are:")
-f = h5py.File(os.path.join(args.path,'data.h5'), 'r')
 
 def print_attrs(name, obj):
     if isinstance(obj, h5py.Dataset):
@@ -111,4 +165,47 @@ def print_attrs(name, obj):
     else:
         print(name)
 
-f.visititems(print_attrs)
\ No newline at end of file
+
+def main():
+    parser = argparse.ArgumentParser(description='[MVCC]')
+    parser.add_argument('--path', type=str, required=False, help='working directory')
+    parser.add_argument('--subpath', default='raw_data', type=str, required=False, help='data or rawdata')
+    parser.add_argument('--sm_format', default='pandas', type=str, choices=['pandas', 'topk', 'dense'], required=False,
+                        help='pandas: dense DataFrame, topk: top k weights of every cell, dense: float32 matrix')
+    parser.add_argument('--sm_k', default=50, type=int, required=False,
+                        help='number of neighbors kept by the topk format, should not be smaller than k_neighbor')
+    parser.add_argument('--chunksize', default=0, type=int, required=False,
+                        help='rows per chunk of the streaming conversion, 0 reads every csv at once')
+    parser.add_argument('--workers', default=1, type=int, required=False,
+                        help='processes converting files in parallel (streaming conversion only)')
+    args = parser.parse_args()
+
+    # args.path = r'..\experiment\multi_ref\MCA_liver'
+    data_path = os.path.join(args.path, args.subpath)
+    # data_path = os.path.join(args.path, 'raw_data')
+    ref_path = os.path.join(data_path, 'ref')
+    query_path = os.path.join(data_path, 'query')
+
+    # model_path = os.path.join(args.path, 'MVCC')
+    # result_path = os.path.join(args.path, 'result')
+
+    jobs = []
+    print("path is "+args.path)
+    print("Start to process ref data")
+    process_dir(args, ref_path, 'ref', jobs)
+
+    print("Start to process query data")
+    process_dir(args, query_path, 'query', jobs)
+
+    if len(jobs) > 0:
+        if args.sm_format == 'pandas':
+            print("streaming conversion stores similarity matrices as float32 dense matrices")
+        run_jobs(args, jobs)
+
+    print("data.h5 keys are:")
+    with h5py.File(os.path.join(args.path, 'data.h5'), 'r') as f:
+        f.visititems(print_attrs)
+
+
+if __name__ == '__main__':
+    main()
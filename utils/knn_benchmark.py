@@ -0,0 +1,52 @@
+"""
+    build time and recall of the approximate kNN backends of MVCC.knn.KNNIndex against the exact one,
+    on clustered gaussian data of several sizes, to see from which size an approximate backend pays off
+
+    python utils/knn_benchmark.py --sizes 5000x30 20000x30 20000x200 60000x50
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MVCC.knn import KNNIndex, hnswlib
+
+
+parser = argparse.ArgumentParser(description='[MVCC]')
+parser.add_argument('--sizes', nargs='+', default=['5000x30', '20000x30', '20000x200', '60000x50'],
+                    help='cells x features of every data set')
+parser.add_argument('--k', default=15, type=int, required=False, help='number of neighbors')
+parser.add_argument('--clusters', default=30, type=int, required=False, help='gaussian clusters of the data')
+parser.add_argument('--n_jobs', default=None, type=int, required=False, help='threads, default all cores')
+parser.add_argument('--seed', default=0, type=int, required=False)
+args = parser.parse_args()
+
+
+def clustered_data(n, d, rng):
+    centers = rng.normal(size=(args.clusters, d)) * 3
+    scales = rng.uniform(0.5, 1.5, args.clusters)
+    labels = rng.integers(0, args.clusters, n)
+    return (centers[labels] + rng.normal(size=(n, d)) * scales[labels].reshape(-1, 1)).astype(np.float32)
+
+
+def recall(idx, exact_idx):
+    return (np.sort(idx, axis=1)[:, :, None] == exact_idx[:, None, :]).any(axis=2).mean()
+
+
+methods = ['nndescent'] + (['hnsw'] if hnswlib is not None else [])
+rng = np.random.default_rng(args.seed)
+print('{:>14} {:>10} '.format('cells x dims', 'exact') + ' '.join('{:>20}'.format(m) for m in methods))
+for size in args.sizes:
+    n, d = [int(v) for v in size.split('x')]
+    data = clustered_data(n, d, rng)
+    start = time.time()
+    exact_idx, _ = KNNIndex('exact', n_jobs=args.n_jobs).build(data, args.k).query(None, args.k)
+    row = '{:>14} {:>9.1f}s '.format(size, time.time() - start)
+    for method in methods:
+        start = time.time()
+        idx, _ = KNNIndex(method, n_jobs=args.n_jobs, seed=args.seed).build(data, args.k).query(None, args.k)
+        row += ' {:>8.1f}s recall {:.3f}'.format(time.time() - start, recall(idx, exact_idx))
+    print(row, flush=True)